@@ -1,8 +1,10 @@
 """Build sources to remove dependencies from host
 """
 import os
+import shutil
 import utils
 from utils.build import *
+from utils.cmdline import get_internal_fn
 
 def args_build(parser):
     parser.add_argument(
@@ -28,6 +30,24 @@ def args_build(parser):
         action="store_true",
         default=False,
         help="Install kernel headers (used in custom build target)")
+    parser.add_argument(
+        '--changed',
+        action="store_true",
+        default=False,
+        help="Compile only the files modified in the work tree (kernel only)")
+    parser.add_argument(
+        '--rev',
+        metavar='COMMIT',
+        help="Build COMMIT in its own cached worktree instead of the work tree")
+    parser.add_argument(
+        '--variant',
+        metavar='NAME',
+        help="Build in the object directory of the variant NAME (kernel only)")
+    parser.add_argument(
+        '--worker',
+        action="store_true",
+        default=False,
+        help="Build in a long lived container of the project instead of a new one")
 
 def cmd_build(args):
     """Smart build."""
@@ -39,7 +59,26 @@ def cmd_build(args):
     if args.project != 'custom' and args.with_kernel_headers:
         exit("--with-kernel-headers is applicable for \"custom\" target only.")
 
+    if args.project != 'kernel' and args.changed:
+        exit("--changed is applicable for \"kernel\" target only.")
+
+    if args.project != 'kernel' and args.variant:
+        exit("--variant is applicable for \"kernel\" target only.")
+
     build = Build(args.project)
+    if args.rev:
+        # The worktree is in the build area, which the container mounts
+        tree = build.src
+        build.src = rev_worktree(build.src, args.rev)
+        print("Building %s in %s" % (args.rev, build.src))
+        config = os.path.join(build.src, ".config")
+        if args.project == 'kernel' and not args.variant and not os.path.exists(config):
+            # In tree builds of the revision start with the config of the
+            # work tree, or the one mkt run boots with
+            if os.path.exists(os.path.join(tree, ".config")):
+                shutil.copy(os.path.join(tree, ".config"), config)
+            else:
+                shutil.copy(get_internal_fn("configs/kconfig-kvm"), config)
 
     recipe_dir = None
     if args.build_recipe is not None:
@@ -55,9 +94,21 @@ def cmd_build(args):
     build.pickle["home"] = os.getenv("HOME")
     build.pickle['clean'] = args.clean
     build.pickle['build_recipe'] = args.build_recipe
+    build.pickle['changed'] = args.changed
+
+    if args.variant:
+        odir = variant_dir(build.src, args.variant)
+        os.makedirs(odir, exist_ok=True)
+        # New variants start with the config mkt run boots with
+        if not os.path.exists(os.path.join(odir, ".config")):
+            shutil.copy(get_internal_fn("configs/kconfig-kvm"), os.path.join(odir, ".config"))
+        build.pickle['variant_dir'] = odir
 
     if args.with_kernel_headers:
         build.pickle['kernel'] = section.get('kernel', None)
 
     do_cmd = ["python3", "/plugins/do-build.py"]
+    # The worker can't mount the directory of every recipe
+    if args.worker and not args.build_recipe:
+        docker_exec(build.worker_build_cmd(cmd_images.default_os) + do_cmd)
     docker_exec(["run"] + build.run_build_cmd(cmd_images.default_os, recipe_dir) + do_cmd)
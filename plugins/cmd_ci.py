@@ -1,8 +1,15 @@
 """Perform CI checks locally
 """
 import os
+import sys
+import time
+import threading
+import subprocess
+import hashlib
 import utils
+from utils.config import username
 from utils.build import *
+from utils.git import *
 
 def args_ci(parser):
     parser.add_argument(
@@ -20,7 +27,12 @@ def args_ci(parser):
         "--rev",
         nargs=1,
         default=['HEAD'],
-        help="Commit to check")
+        help="Commit or range of commits (A..B) to check")
+    parser.add_argument(
+        "--series",
+        action="store_true",
+        help="Check every commit between the merge base with the remote branches and --rev",
+        default=False)
     parser.add_argument(
         "--no-sparse",
         action="store_false",
@@ -43,8 +55,14 @@ def args_ci(parser):
         "--no-extra-warnings",
         action="store_false",
         dest="warnings",
-        help="Skip W=1 compilation",
+        help="Skip W=1 compilation, or the compile check of user space projects",
         default=True)
+    parser.add_argument(
+        "--parallel-warnings",
+        action="store_true",
+        dest="parallel_warnings",
+        help="Build all W=1 configurations at the same time",
+        default=False)
     parser.add_argument(
         "--no-smatch",
         action="store_false",
@@ -57,6 +75,157 @@ def args_ci(parser):
         dest="clang",
         help="Skip CLANG checks",
         default=True)
+    parser.add_argument(
+        "--fast-clang",
+        action="store_true",
+        dest="fast_clang",
+        help="Run clang -fsyntax-only with the flags of the gcc build instead of a full clang build",
+        default=False)
+    parser.add_argument(
+        "--exhaustive",
+        action="store_true",
+        dest="exhaustive",
+        help="Build with allyesconfig, allnoconfig and allmodconfig instead of a minimal config",
+        default=False)
+    parser.add_argument(
+        "--checkout",
+        choices=["full", "sparse", "overlay"],
+        default="full",
+        help="How to check out the tree in the container")
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        dest="fail_fast",
+        help="Stop after the first check that finds issues",
+        default=False)
+    parser.add_argument(
+        "--budget",
+        type=int,
+        metavar="MIN",
+        help="Only run the checks that are expected to finish within MIN minutes")
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and check the commits again every time they change",
+        default=False)
+    parser.add_argument(
+        "--queue",
+        action="store_true",
+        help="Submit the check to the host wide CI queue, see mkt ci-queue",
+        default=False)
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Check in a long lived container of the project instead of a new one",
+        default=False)
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Check again even if the same patch was already checked",
+        default=False)
+
+def get_revs(args, src):
+    """Return the list of commits to check, oldest first"""
+    rev = args.rev[0]
+    with in_directory(src):
+        if args.series:
+            rng = git_base_fewest_commits(None, rev)
+        elif ".." in rev:
+            ancestor, _, newest = rev.partition("..")
+            rng = GitRange(newest or "HEAD", ancestor or "HEAD")
+        else:
+            # Full IDs, the queue and the result cache key on them
+            return [git_commit_id(rev)]
+        rng.sanity_check()
+        revs = rng.get_commit_list(extra_args=["--reverse"])
+    if not revs:
+        exit("There are no commits to check in %s" %(rev))
+    return revs
+
+def tee(stream, fn):
+    """Copy the output of a CI run to the terminal and to fn"""
+    with open(fn, "wb") as F:
+        for line in stream:
+            sys.stdout.buffer.write(line)
+            sys.stdout.flush()
+            F.write(line)
+
+def cancel_ci(name):
+    """Stop the CI run in the watch container. Every run is its own session,
+    TERM goes first so make deletes the objects it did not finish."""
+    kill = "for s in $sids; do pkill -%s -s $s; done"
+    script = "sids=$(pgrep -f '[/]plugins/do-ci.py'); %s; sleep 2; %s; true" %(
+        kill %("TERM"), kill %("KILL"))
+    docker_call(["exec", name, "sh", "-c", script])
+
+def watch_ci(args, build, supos):
+    """Check the commits in a long lived container every time they change.
+    The container keeps the fork and the object directories between the runs
+    so each of them is incremental, and a run is cancelled as soon as newer
+    commits replace the ones it checks."""
+    name = "mkt-ci-%s-%s" %(username(), args.project)
+    build.pickle['watch'] = True
+    subprocess.call(["sudo", "docker", "rm", "-f", name],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    docker_call(["run", "-d", "--name", name] + build.run_ci_cmd(supos) +
+                ["sleep", "infinity"])
+    print("Watching %s, press Ctrl-C to stop" %(build.src))
+
+    checked = None
+    proc = None
+    try:
+        while True:
+            revs = get_revs(args, build.src)
+            if revs != checked:
+                if proc and proc.poll() is None:
+                    print("\n==> Cancelled, the commits were changed")
+                    cancel_ci(name)
+                    proc.wait()
+                checked = revs
+
+                # Every commit gets its own logs
+                logs = revs[-1][:12]
+                os.makedirs(os.path.join(utils.config.runtime_logs_dir, logs), exist_ok=True)
+                build.pickle['rev'] = revs[-1]
+                build.pickle['revs'] = revs
+                build.pickle['logs'] = os.path.join("/logs", logs)
+                proc = docker_popen(["exec", "-e", "CI_PICKLE=%s" %(build._get_pickle()), name,
+                                     "setsid", "-w", "python3", "/plugins/do-ci.py"],
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                threading.Thread(target=tee, daemon=True, args=(
+                    proc.stdout, os.path.join(utils.config.runtime_logs_dir, logs, "ci.log"))).start()
+            time.sleep(2)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        subprocess.call(["sudo", "docker", "rm", "-f", name], stdout=subprocess.DEVNULL)
+
+def queue_key(build, revs):
+    """Identify the check by the patches and messages of the commits and by
+    the options, the same way the result cache of do-ci.py does"""
+    h = hashlib.sha256()
+    with in_directory(build.src):
+        for I in revs:
+            h.update((git_patch_id(I) or "").encode())
+            h.update(git_output(["log", "-n1", "--format=%B", I]))
+    for k, v in sorted(build.pickle.items()):
+        if k not in ("rev", "revs", "src", "checkpatch_root_dir"):
+            h.update(("%s=%s\0" %(k, v)).encode())
+    return h.hexdigest()
+
+def queue_ci(build, revs):
+    from . import cmd_ci_queue
+    with in_directory(build.src):
+        subject = git_output(["log", "-n1", "--format=%h %s", revs[-1]]).decode()
+    res = cmd_ci_queue.submit(queue_key(build, revs), build,
+                              utils.config.runtime_logs_dir, subject)
+    if res.get("error"):
+        exit("The CI queue refused the check: %s" %(res["error"]))
+    if res["dup"]:
+        print("The same check is already job %d, see mkt ci-queue results %d"
+              %(res["id"], res["id"]))
+    else:
+        print("Queued as job %d, see mkt ci-queue results %d" %(res["id"], res["id"]))
 
 def cmd_ci(args):
     """Local continuous integration check."""
@@ -71,12 +240,28 @@ def cmd_ci(args):
     build.pickle['gerrit'] = args.gerrit
     build.pickle['show_all'] = args.show_all
     build.pickle["warnings"] = args.warnings
+    build.pickle["parallel_warnings"] = args.parallel_warnings
     build.pickle["smatch"] = args.smatch
     build.pickle["clang"] = args.clang
+    build.pickle["fast_clang"] = args.fast_clang
+    build.pickle["exhaustive"] = args.exhaustive
+    build.pickle["checkout"] = args.checkout
+    build.pickle["fail_fast"] = args.fail_fast
+    build.pickle["budget"] = args.budget
+    build.pickle["force"] = args.force
+
+    if args.watch:
+        watch_ci(args, build, cmd_images.default_os)
+        return
+
+    revs = get_revs(args, build.src)
+    build.pickle['rev'] = revs[-1]
+    build.pickle['revs'] = revs
+    if args.queue:
+        queue_ci(build, revs)
+        return
 
-    # FIXME: allow git revisions as input to --rev.
-    # But for now, let's give an option to provide
-    # commit.
-    build.pickle['rev'] = args.rev[0]
     do_cmd = ["python3", "/plugins/do-ci.py"]
+    if args.worker:
+        docker_exec(build.worker_ci_cmd(cmd_images.default_os) + do_cmd)
     docker_exec(["run"] + build.run_ci_cmd(cmd_images.default_os) + do_cmd)
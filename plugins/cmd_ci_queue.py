@@ -0,0 +1,235 @@
+"""Host wide queue for the local CI
+"""
+import os
+import re
+import grp
+import pwd
+import json
+import struct
+import socket
+import threading
+import subprocess
+import socketserver
+import utils
+
+# The queue serves everyone on the host who may run docker anyway
+socket_fn = "/tmp/mkt-ci-queue.sock"
+socket_group = "docker"
+
+def is_bool(v):
+    return isinstance(v, bool)
+
+# The mkt ci options a queued job may set and the values they may take,
+# anything else in a request is refused
+options = {
+    "checkpatch": is_bool,
+    "sparse": is_bool,
+    "gerrit": is_bool,
+    "show_all": is_bool,
+    "warnings": is_bool,
+    "parallel_warnings": is_bool,
+    "smatch": is_bool,
+    "clang": is_bool,
+    "fast_clang": is_bool,
+    "exhaustive": is_bool,
+    "checkout": lambda v: v in ("full", "sparse", "overlay"),
+    "fail_fast": is_bool,
+    "budget": lambda v: v is None or (type(v) is int and v > 0),
+    "force": is_bool,
+}
+
+def args_ci_queue(parser):
+    parser.add_argument(
+        "action",
+        choices=["daemon", "status", "results"],
+        help="Run the queue, list its jobs or show the output of a job")
+    parser.add_argument(
+        "job",
+        nargs='?',
+        type=int,
+        help="Job to show the results of")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=max(1, os.cpu_count() // 16),
+        help="Number of CI runs the daemon does at the same time")
+
+def request(req):
+    """Send a request to the daemon and return its reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_fn)
+        except (FileNotFoundError, ConnectionRefusedError):
+            exit("The CI queue is not running, start it with mkt ci-queue daemon")
+        with sock.makefile("rw") as F:
+            F.write(json.dumps(req) + "\n")
+            F.flush()
+            return json.loads(F.readline())
+
+def submit(key, build, logs, subject):
+    """Queue the check of build, unless a job with the same key is already
+    there. Returns the reply of the daemon."""
+    return request({"op": "submit", "key": key, "project": build.project,
+                    "src": build.src, "revs": build.pickle["revs"],
+                    "options": {k: v for k, v in build.pickle.items() if k in options},
+                    "logs": logs, "subject": subject})
+
+def owned_dir(path, uid):
+    return (isinstance(path, str) and os.path.isabs(path) and
+            os.path.isdir(path) and os.stat(path).st_uid == uid)
+
+def check_submit(req, uid):
+    """Return why the daemon refuses the submitted job, None if it is fine.
+    The daemon builds the docker command itself, the client only picks the
+    tree and the options of the check."""
+    if req.get("project") not in ("kernel", "rdma-core", "iproute2"):
+        return "Unsupported project %r" %(req.get("project"))
+    if not owned_dir(req.get("src"), uid) or not os.path.isdir(os.path.join(req["src"], ".git")):
+        return "The source tree must be a git tree of the submitter"
+    if not owned_dir(req.get("logs"), uid):
+        return "The logs directory must belong to the submitter"
+    revs = req.get("revs")
+    if (not isinstance(revs, list) or not revs or
+        not all(isinstance(I, str) and re.fullmatch(r"[0-9a-f]{40}", I) for I in revs)):
+        return "Revisions must be full commit IDs"
+    opts = req.get("options")
+    if not isinstance(opts, dict):
+        return "Missing options"
+    for k, v in opts.items():
+        if k not in options or not options[k](v):
+            return "Option %s=%r is not allowed" %(k, v)
+    for k in ("key", "subject"):
+        if not isinstance(req.get(k), str):
+            return "Missing %s" %(k)
+    return None
+
+def ci_cmd(job):
+    """The docker run arguments of the check of job"""
+    from . import cmd_images
+    from utils.build import Build
+
+    build = Build(job["project"], job["src"])
+    build.pickle.update(job["options"])
+    build.pickle["revs"] = job["revs"]
+    build.pickle["rev"] = job["revs"][-1]
+    # The queue runs the container without a terminal and keeps the output
+    # with the reports
+    cmd = [I for I in build.run_ci_cmd(cmd_images.default_os, job["logs"]) if I != "-it"]
+    return cmd + ["sh", "-c", "python3 /plugins/do-ci.py > /logs/ci.log 2>&1"]
+
+class Queue(object):
+    """The jobs of the daemon. Jobs with the same key, the patch-ids and
+    messages of the commits and the CI options, are the same job."""
+    def __init__(self, num_jobs):
+        self.num_jobs = num_jobs
+        self.jobs = []
+        self.lock = threading.Condition()
+
+    def submit(self, req):
+        with self.lock:
+            for job in self.jobs:
+                if job["key"] == req["key"] and job["state"] != "failed":
+                    return {"id": job["id"], "logs": job["logs"], "dup": True}
+            job = {k: req[k] for k in ("key", "project", "src", "revs",
+                                       "options", "logs", "subject", "user")}
+            job.update(id=len(self.jobs) + 1, state="queued")
+            self.jobs.append(job)
+            self.lock.notify()
+            return {"id": job["id"], "logs": job["logs"], "dup": False}
+
+    def status(self):
+        with self.lock:
+            return [{k: I[k] for k in ("id", "state", "user", "subject", "logs")}
+                    for I in self.jobs]
+
+    def worker(self):
+        while True:
+            with self.lock:
+                while True:
+                    job = next((I for I in self.jobs if I["state"] == "queued"), None)
+                    if job:
+                        break
+                    self.lock.wait()
+                job["state"] = "running"
+
+            # Every run gets an equal share of the CPUs
+            num_jobs = max(1, len(os.sched_getaffinity(0)) * 2 // self.num_jobs)
+            rc = subprocess.call(["sudo", "docker", "run", "-e", "CI_NUM_JOBS=%d" %(num_jobs)] +
+                                 ci_cmd(job), stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+            with self.lock:
+                job["state"] = "failed" if rc else "done"
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        req = json.loads(self.rfile.readline())
+        queue = self.server.queue
+        # The submitter is who the kernel says is on the other end
+        creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                        struct.calcsize("3i"))
+        uid = struct.unpack("3i", creds)[1]
+        if not isinstance(req, dict):
+            res = {"error": "Malformed request"}
+        elif req.get("op") == "submit":
+            res = {"error": check_submit(req, uid)}
+            if res["error"] is None:
+                res = queue.submit(dict(req, user=pwd.getpwuid(uid)[0]))
+        elif req.get("op") == "status":
+            res = queue.status()
+        else:
+            res = {"error": "Unknown request %r" %(req.get("op"))}
+        self.wfile.write((json.dumps(res) + "\n").encode())
+
+def daemon(args):
+    if os.path.exists(socket_fn):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(socket_fn)
+                exit("The CI queue is already running")
+            except ConnectionRefusedError:
+                # Left by a daemon that was killed
+                os.unlink(socket_fn)
+
+    server = socketserver.ThreadingUnixStreamServer(socket_fn, Handler)
+    # Jobs run as root in a container, only users who may run docker
+    # themselves can submit them
+    try:
+        os.chown(socket_fn, -1, grp.getgrnam(socket_group).gr_gid)
+        os.chmod(socket_fn, 0o660)
+    except (KeyError, PermissionError):
+        os.chmod(socket_fn, 0o600)
+        print("Only %s can submit jobs, the daemon user is not in the %s group"
+              %(utils.username(), socket_group))
+    server.queue = Queue(args.jobs)
+    for I in range(args.jobs):
+        threading.Thread(target=server.queue.worker, daemon=True).start()
+    print("CI queue is running %d job(s) at a time on %s" %(args.jobs, socket_fn))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(socket_fn)
+
+def cmd_ci_queue(args):
+    """Host wide queue for mkt ci --queue."""
+    if args.action == "daemon":
+        daemon(args)
+        return
+
+    jobs = request({"op": "status"})
+    if args.action == "status":
+        for job in jobs:
+            print("%4d %-8s %-12s %s" %(job["id"], job["state"], job["user"], job["subject"]))
+        return
+
+    job = next((I for I in jobs if I["id"] == args.job), None)
+    if job is None:
+        exit("There is no job %s in the CI queue" %(args.job))
+    if job["state"] in ("queued", "running"):
+        exit("Job %d is %s, its results will be in %s" %(job["id"], job["state"], job["logs"]))
+    try:
+        with open(os.path.join(job["logs"], "ci.log")) as F:
+            print(F.read(), end='')
+    except FileNotFoundError:
+        exit("Job %d %s without results" %(job["id"], job["state"]))
@@ -16,6 +16,7 @@ import collections
 import random
 from utils.docker import *
 from utils.cmdline import *
+from utils.build import variant_dir
 from . import cmd_images
 
 VM_Addr = collections.namedtuple("VM_Addr", "hostname ip mac")
@@ -292,6 +293,11 @@ def args_run(parser):
         default=section.get('kernel', None))
     kernel.add_argument(
         '--kernel-rpm', help="Path to a kernel RPM to boot", default=None)
+    parser.add_argument(
+        '--variant',
+        metavar='NAME',
+        help="Boot the build variant NAME of the kernel tree, see mkt build --variant",
+        default=None)
 
     parser.add_argument(
         '--dir', action="append", help="Other paths to map", default=[])
@@ -377,6 +383,8 @@ def cmd_run(args):
         exit(
             "Must specify a linux kernel with --kernel, or a config file default"
         )
+    if args.kernel_rpm and args.variant:
+        exit("--variant can't be used with --kernel-rpm")
 
     # Invoke ourself as root to manipulate sysfs
     if args.pci:
@@ -399,6 +407,12 @@ def cmd_run(args):
             raise ValueError("Kernel path %r is not a directory/does not exist"
                              % (args.kernel))
         mapdirs.add(args.kernel)
+        if args.variant:
+            # The objects of the variant refer to the sources of the tree
+            args.kernel = variant_dir(args.kernel, args.variant)
+            if not os.path.isdir(args.kernel):
+                raise ValueError("Kernel variant %r was not built" % (args.variant))
+            mapdirs.add(args.kernel)
 
     if args.image:
         try:
@@ -5,6 +5,24 @@ import subprocess
 import pickle
 import base64
 import argparse
+from kbuild import object_target
+
+def changed_targets():
+    """Return the make targets for the files modified in the work tree and
+    whether they cover all the changes. C files are built as their object,
+    other files in a directory with a Makefile as the whole directory."""
+    files = subprocess.check_output(['git', 'diff', '--name-only', 'HEAD'])
+    targets = set()
+    complete = True
+    for f in files.decode().split():
+        obj = object_target(f)
+        if obj:
+            targets.add(obj)
+        elif f.endswith(".c") and os.path.isfile(os.path.join(os.path.dirname(f), 'Makefile')):
+            targets.add(os.path.join(os.path.dirname(f), ''))
+        else:
+            complete = False
+    return sorted(targets), complete
 
 def make_kernel(args):
     if args.clean:
@@ -14,6 +32,16 @@ def make_kernel(args):
     if os.path.isdir('/ccache'):
         cmd += ['CC=ccache gcc']
 
+    if args.changed:
+        targets, complete = changed_targets()
+        if targets:
+            print('Compile changed files: %s' %(' '.join(targets)))
+            if subprocess.call(cmd + ['-j%d' %(args.num_jobs), '-s'] + targets):
+                return
+        # Headers, Makefiles and the like can affect anything
+        if complete:
+            return
+
     print('Start kernel compilation in silent mode')
     subprocess.call(cmd + ['-j%d' %(args.num_jobs), '-s'])
 
@@ -42,11 +70,17 @@ def make_simx(args):
 
     subprocess.call(cmd + ['-j%d' %(args.num_jobs)])
 
+def add_line(fn, line):
+    """Append line to fn unless it is already there"""
+    with open(fn, "a+") as F:
+        F.seek(0)
+        if line not in F.read().splitlines():
+            F.write(line + "\n")
+
 def switch_to_user(args):
-    with open("/etc/passwd","a") as F:
-        F.write(args.passwd + "\n");
-    with open("/etc/group","a") as F:
-        F.write(args.group + "\n");
+    # Worker containers run many builds
+    add_line("/etc/passwd", args.passwd)
+    add_line("/etc/group", args.group)
     os.setgid(args.gid);
     os.setuid(args.uid);
     os.environ['HOME'] = args.home
@@ -67,6 +101,8 @@ def setup_from_pickle(args, pickle_params):
     args.home = p.get('home', None)
     args.build_recipe = p.get('build_recipe', None)
     args.kernel = p.get('kernel', None)
+    args.changed = p.get('changed', False)
+    args.variant_dir = p.get('variant_dir', None)
 
 parser = argparse.ArgumentParser(description='CI container')
 args = parser.parse_args()
@@ -82,6 +118,9 @@ if args.project and args.kernel:
 switch_to_user(args)
 if os.path.isdir('/ccache'):
     os.environ['CCACHE_DIR'] = '/ccache'
+if args.variant_dir:
+    # make takes the object directory from here, in the shell as well
+    os.environ['KBUILD_OUTPUT'] = args.variant_dir
 
 if args.shell:
     os.execvp('/bin/bash', ['/bin/bash'])
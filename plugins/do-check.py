@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""kbuild CHECK wrapper used by do-ci.py. kbuild invokes it once for every
+translation unit with the checker flags and the source file, and it runs all
+the requested checkers over that unit so a single make traversal serves all of
+them. The output of every checker is appended to its own file in the check
+directory.
+
+When a cache directory is given the result of every checker is stored keyed by
+the preprocessed source, the checker binary and the flags, and replayed for
+units that did not change, much like ccache does for the compiler.
+
+smatch uses the cross function database given by do-ci.py. When do-ci.py
+asks for it, smatch also prints what it learns about every unit, that part of
+its output is saved to update the database afterwards and only the warnings
+are reported."""
+
+import os
+import re
+import sys
+import fcntl
+import hashlib
+import shutil
+import subprocess
+
+checkers = {
+    "sparse": ["sparse", "-fdiagnostic-prefix", "-D__CHECK_ENDIAN__"],
+    "smatch": ["/opt/smatch/bin/smatch", "-p=kernel",
+               "--data=/opt/smatch/share/smatch/smatch_data/"],
+}
+
+# Lines of the smatch output that are for the database and not warnings
+smatch_info_re = re.compile(rb"^\S+:\d+ \S+ (info:|SQL)")
+
+def checker_cmd(tool):
+    cmd = list(checkers[tool])
+    if tool == "smatch" and os.environ.get("MKT_SMATCH_DB"):
+        cmd.append("--db-file=%s" %(os.environ["MKT_SMATCH_DB"]))
+    if tool == "smatch" and os.environ.get("MKT_SMATCH_INFO"):
+        # What build_kernel_data.sh collects for the database, without
+        # --spammy which only adds warnings
+        cmd += ["--call-tree", "--info", "--param-mapper"]
+    return cmd
+
+def preprocess(argv):
+    """Return the unit preprocessed with the include paths and defines the
+    checkers get, or None if gcc can not do it. Only the options that affect
+    preprocessing are passed on, the others are sparse specific or would
+    overwrite the kbuild dependency file."""
+    cmd = ["gcc", "-E", "-D__CHECKER__"]
+    itr = iter(argv)
+    for I in itr:
+        if I in ("-include", "-imacros", "-isystem", "-iquote", "-I", "-D", "-U"):
+            cmd += [I, next(itr, "")]
+        elif I.startswith(("-D", "-U", "-I", "-isystem", "-iquote", "-std=")) or I == "-nostdinc":
+            cmd.append(I)
+        elif not I.startswith("-"):
+            cmd.append(I)
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if out.returncode:
+        return None
+    return out.stdout
+
+def file_id(fn):
+    st = os.stat(fn)
+    return [fn, str(st.st_size), str(st.st_mtime)]
+
+def cache_key(tool, argv, source):
+    """The checker binary is identified by its size and mtime, the same way
+    ccache identifies the compiler by default. smatch results also depend on
+    the generation of its cross function database, which only changes when
+    the database is reloaded."""
+    ids = file_id(shutil.which(checkers[tool][0]))
+    if tool == "smatch":
+        ids.append(os.environ.get("MKT_SMATCH_DB_GEN", ""))
+    h = hashlib.sha256()
+    for I in [tool] + ids + checker_cmd(tool) + argv:
+        h.update(I.encode())
+        h.update(b"\0")
+    h.update(source)
+    return h.hexdigest()
+
+def cached_run(tool, argv, cache, source):
+    """Return the exit code and the output of the checker, from the cache
+    when possible"""
+    fn = None
+    if cache and source is not None:
+        key = cache_key(tool, argv, source)
+        fn = os.path.join(cache, tool, key[:2], key)
+        try:
+            with open(fn, "rb") as F:
+                rc, _, out = F.read().partition(b"\n")
+            # Used entries are kept by the pruning of do-ci.py
+            os.utime(fn)
+            return int(rc), out
+        except FileNotFoundError:
+            pass
+
+    # smatch prints on stdout while sparse uses stderr, keep both
+    out = subprocess.run(checker_cmd(tool) + argv, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+    if fn:
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn + ".%d" %(os.getpid()), "wb") as F:
+            F.write(b"%d\n" %(out.returncode) + out.stdout)
+        os.rename(fn + ".%d" %(os.getpid()), fn)
+    return out.returncode, out.stdout
+
+def run_checker(tool, argv, check_dir, cache, source):
+    rc, out = cached_run(tool, argv, cache, source)
+    if tool == "smatch" and os.environ.get("MKT_SMATCH_INFO"):
+        name = hashlib.sha1(argv[-1].encode()).hexdigest()
+        with open(os.path.join(os.environ["MKT_SMATCH_INFO"], name + ".info"), "wb") as F:
+            F.write(out)
+        out = b"".join(I for I in out.splitlines(True) if not smatch_info_re.match(I))
+    if out:
+        # Many make jobs write to the same file, only append whole reports
+        with open(os.path.join(check_dir, tool + ".log"), "ab") as F:
+            fcntl.flock(F, fcntl.LOCK_EX)
+            F.write(out)
+    return rc
+
+tools = os.environ.get("MKT_CHECKERS", "sparse").split()
+check_dir = os.environ.get("MKT_CHECK_DIR", ".")
+cache = os.environ.get("MKT_CHECK_CACHE", None)
+source = preprocess(sys.argv[1:]) if cache else None
+
+rc = 0
+for tool in tools:
+    ret = run_checker(tool, sys.argv[1:], check_dir, cache, source)
+    if not rc:
+        rc = ret
+sys.exit(rc)
@@ -1,11 +1,142 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import sys
+import bisect
+import collections
 import subprocess
 import pickle
 import base64
 import argparse
-from shutil import copy
+import json
+import hashlib
+import sqlite3
+import glob
+import fcntl
+import shlex
+import concurrent.futures
+import shutil
+import signal
+import time
+import socket
+import threading
+from kbuild import object_target
+
+# Paths every kernel build needs whatever its targets are: the top level
+# files, the x86 architecture, the headers, the build tools and all the
+# Kconfig files and Makefiles that kbuild and minimal_config() read.
+sparse_paths = ["/*", "!/*/", "/arch/*", "!/arch/*/", "/arch/x86/", "/include/",
+                "/scripts/", "/tools/", "/usr/", "/kernel/", "/certs/",
+                "Kconfig*", "Makefile*", "Kbuild*"]
+
+def init_fork(dfn, obj_dir):
+    """Create an empty git repository. Native clone is too slow because the
+    typical gerrit source repo has a huge number of refs and git has to
+    inspect all of them. This approach lets us ignore all of that to only
+    use the rev we were asked to build."""
+    os.makedirs(dfn, exist_ok=True)
+    subprocess.check_call(["git", "init", "-q"], cwd=dfn)
+
+    # Setup alternates so we can see all the objects in the source repo
+    with open(os.path.join(dfn, ".git/objects/info/alternates"), "w") as F:
+        F.write(obj_dir)
+        F.write("\n")
+
+def lock_tree(tree, flags):
+    """Return the open lock file of a cached tree or scratch directory locked
+    with flags, None if a non blocking lock is not available. The lock file
+    of a pruned directory is removed, so a lock is only good if the file is
+    still there."""
+    fn = tree + ".lock"
+    while True:
+        F = open(fn, "a")
+        try:
+            fcntl.flock(F, flags)
+        except BlockingIOError:
+            F.close()
+            return None
+        try:
+            if os.fstat(F.fileno()).st_ino == os.stat(fn).st_ino:
+                return F
+        except FileNotFoundError:
+            pass
+        F.close()
+
+def base_tree(args, obj_dir, base):
+    """Return a checkout of base kept on the ccache volume to serve as the
+    read only lower layer of overlay forks, None if there is no volume"""
+    dfn = cache_dir("trees")
+    if dfn is None:
+        return None
+    key = hashlib.sha256(args.src.encode()).hexdigest()[:16]
+    tree = os.path.join(dfn, "%s-%s" %(key, base.decode()))
+    # The tree must not be pruned while it is mounted, which lasts as long as
+    # the container in the watch mode and the workers. The shared lock is
+    # held by a process that lives that long.
+    lock = lock_tree(tree, fcntl.LOCK_SH)
+    subprocess.Popen(["sleep", "infinity"], pass_fds=[lock.fileno()],
+                     start_new_session=True)
+    lock.close()
+    if not os.path.isdir(tree):
+        tmp = "%s.%d" %(tree, os.getpid())
+        init_fork(tmp, obj_dir)
+        # The overlay shows other inode and device numbers than the ones in
+        # the index of the tree, don't let git rehash every file because of
+        # that.
+        subprocess.check_call(["git", "config", "core.checkStat", "minimal"], cwd=tmp)
+        subprocess.check_call(["git", "config", "core.trustctime", "false"], cwd=tmp)
+        subprocess.check_call(["git", "checkout", "-q", "--detach", base], cwd=tmp)
+        try:
+            os.rename(tmp, tree)
+        except OSError:
+            # Another CI run created it at the same time
+            shutil.rmtree(tmp)
+    os.utime(tree)
+
+    # Every tree is a full checkout, keep only the recently used ones that
+    # no overlay uses
+    trees = [I for I in glob.glob(os.path.join(dfn, "*")) if "." not in os.path.basename(I)]
+    for I in sorted(trees, key=os.path.getmtime)[:-3]:
+        lock = lock_tree(I, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if lock is None:
+            continue
+        shutil.rmtree(I, ignore_errors=True)
+        os.unlink(I + ".lock")
+        lock.close()
+    return tree
+
+def overlay_fork(args, obj_dir, base, dfn):
+    """Mount the cached checkout of base with a writable layer on top at dfn,
+    the checkout of the commit then only writes the files it changes"""
+    lower = base_tree(args, obj_dir, base)
+    if lower is None:
+        print("Overlay checkout needs the ccache volume, doing a full checkout")
+        return False
+    upper = "/build/overlay/upper"
+    work = "/build/overlay/work"
+    for I in (upper, work, dfn):
+        os.makedirs(I)
+    if subprocess.call(["mount", "-t", "overlay", "overlay", "-o",
+                        "lowerdir=%s,upperdir=%s,workdir=%s" %(lower, upper, work), dfn]):
+        print("Failed to mount the overlay, doing a full checkout")
+        return False
+    return True
+
+def widen_checkout(args, paths):
+    """Add paths, relative to the top of the tree, to a sparse checkout"""
+    if args.checkout != "sparse" or args.project != "kernel":
+        return
+    fn = os.path.join(args.src, ".git/info/sparse-checkout")
+    with open(fn) as F:
+        cur = set(F.read().split())
+    new = set("/" + I for I in paths) - cur
+    if not new:
+        return
+    with open(fn, "a") as F:
+        for I in sorted(new):
+            F.write(I + "\n")
+    subprocess.check_call(["git", "read-tree", "-mu", "HEAD"], cwd=args.src)
 
 def fork(args):
     """Checkout the linux source tree into the build directory so that everything
@@ -14,115 +145,1098 @@ def fork(args):
     obj_dir = subprocess.check_output(["git", "rev-parse", "--git-path", "objects"],
                                       cwd=args.src)
     obj_dir = os.path.join(args.src, obj_dir.decode())
+    revs = args.revs if args.revs else [head]
+    base = subprocess.run(["git", "rev-parse", "-q", "--verify", revs[0].decode() + "~1"],
+                          cwd=args.src, stdout=subprocess.PIPE).stdout.strip() or head
 
-    # Create an empty git repository. Native clone is too slow because the
-    # typical gerrit source repo has a huge number of refs and git has to
-    # inspect all of them. This approach lets us ignore all of that to only
-    # use the rev we were asked to build.
-    os.mkdir("/build/%s" %(args.project))
-    os.chdir("/build/%s" %(args.project))
-    subprocess.check_call(["git", "init", "-q"])
-
-    # Setup alternates so we can see all the objects in the source repo
-    with open(".git/objects/info/alternates", "w") as F:
-        F.write(obj_dir)
-        F.write("\n")
+    dfn = "/build/%s" %(args.project)
+    if os.path.isdir(os.path.join(dfn, ".git")):
+        # A previous run in the same container left its fork, possibly
+        # cancelled in the middle, only the new commit has to be checked out
+        if os.path.exists(os.path.join(dfn, ".git/index.lock")):
+            os.unlink(os.path.join(dfn, ".git/index.lock"))
+    elif args.checkout == "overlay" and overlay_fork(args, obj_dir, base, dfn):
+        pass
+    else:
+        init_fork(dfn, obj_dir)
+        if args.checkout == "sparse" and args.project == "kernel":
+            subprocess.check_call(["git", "config", "core.sparseCheckout", "true"], cwd=dfn)
+            # The directories of the changed files are needed to find the
+            # targets, the rest is added by widen_checkout() when known.
+            files = subprocess.check_output(["git", "diff", "--name-only", base, head],
+                                            cwd=args.src).decode().split()
+            paths = sparse_paths + sorted(set("/" + os.path.join(os.path.dirname(I), "")
+                                              for I in files))
+            with open(os.path.join(dfn, ".git/info/sparse-checkout"), "w") as F:
+                F.write("\n".join(paths) + "\n")
+    os.chdir(dfn)
 
     # Create a branch using the only remote HEAD we care about
-    subprocess.check_call(["git", "checkout", "-q", "-b", "build", "--no-progress", head])
+    subprocess.check_call(["git", "checkout", "-q", "-f", "-B", "build", "--no-progress", head])
     subprocess.check_call(["git", "--no-pager", "log", "--oneline", "-n1"])
 
-    if args.project == "kernel":
-        copy("%s/.config" %(args.src), "/build/%s" %(args.project))
-
-    args.src = "/build/%s" %(args.project)
+    args.tree = args.src
+    args.src = dfn
     args.rev = head
 
-def build_dirlist(args):
+def commit_targets(args, rev):
+    """Compute the make targets to check for commit rev. Changed C files are
+    checked as their object file, everything else as the whole directory.
+    Returns the targets, the changed files and if the findings should be
+    filtered by the diff."""
     files = subprocess.check_output(["git", "show", "--name-only",
-        "--oneline", args.rev], cwd=args.src).decode().split('\n')
+        "--oneline", rev], cwd=args.src).decode().split('\n')
     # Remove subjet line
     files = files[1:]
     # Leave only directories which we know how to check
     supported = ("arch", "block", "crypto", "fs", "init", "ipc", "kernel",
         "lib", "mm", "drivers", "net", "security", "sound", "virt")
     dirlist = set()
+    objects = set()
+    changed = False
     is_include_was_changed = False
     for f in files:
         if f.startswith(supported):
-            dirlist.add(os.path.join(os.path.dirname(f), ''))
+            changed = True
+            obj = object_target(f)
+            if obj:
+                objects.add(obj)
+            else:
+                dirlist.add(os.path.join(os.path.dirname(f), ''))
         if f.startswith("include"):
             is_include_was_changed = True
 
-    args.filter_by_diff = False
-    if not dirlist and is_include_was_changed:
-        # Let's do smart guess and try to check subsystems,
-        # which we are changing most of the time.
-        dirlist.add("drivers/infiniband/")
-        dirlist.add("lib/")
-        dirlist.add("drivers/net/ethernet/mellanox/")
-        dirlist.add("net/")
-        dirlist.add("drivers/nvme/")
-        dirlist.add("mm/")
-        args.filter_by_diff = True
-
-    args.dirlist = list(dirlist)
-    args.files = files
-
-def print_filtered_output(args, out):
-    # sparse output everything on stderr
-    for line in out.stderr.split('\n'):
-        l = line.split(":")
+    # Add every source that includes a changed header
+    unknown = False
+    for f in files:
+        if not f.endswith(".h"):
+            continue
+        users = args.deps.users(f)
+        if not args.deps.exact(f):
+            unknown = unknown or f.startswith("include")
+        for src in users or ():
+            obj = object_target(src)
+            if obj:
+                objects.add(obj)
+            else:
+                dirlist.add(os.path.join(os.path.dirname(src), ''))
+
+    filter_by_diff = False
+    if not changed and is_include_was_changed:
+        if unknown or not (dirlist or objects):
+            # Let's do smart guess and try to check subsystems,
+            # which we are changing most of the time.
+            dirlist.add("drivers/infiniband/")
+            dirlist.add("lib/")
+            dirlist.add("drivers/net/ethernet/mellanox/")
+            dirlist.add("net/")
+            dirlist.add("drivers/nvme/")
+            dirlist.add("mm/")
+        filter_by_diff = True
+
+    # Objects inside a directory that is checked anyway are redundant
+    objects = [I for I in objects if not I.startswith(tuple(dirlist))]
+    return sorted(dirlist) + sorted(objects), set(files), filter_by_diff
+
+def build_dirlist(args):
+    args.dirlist, args.files, args.filter_by_diff = commit_targets(args, args.rev)
+
+def make_cmd(args, odir=None, cc=None, num_jobs=None):
+    if num_jobs is None:
+        num_jobs = args.num_jobs
+    cmd = ["make", "-j", str(num_jobs), "-s"]
+    if odir:
+        cmd += ["O=%s" %(odir)]
+    cc = cc or "gcc"
+    if os.path.isdir("/ccache"):
+        # ccache hashes the compiler and all its flags, including the config
+        # header, so the compilers and configs never get each other's objects
+        cc = "ccache " + cc
+    return cmd + ["CC=%s" %(cc)]
+
+def ccache_stats():
+    """Return the counters printed by ccache -s"""
+    out = subprocess.run(["ccache", "-s"], stdout=subprocess.PIPE, encoding='utf-8')
+    res = collections.OrderedDict()
+    for line in out.stdout.splitlines():
+        g = re.match(r"^(\S.*?)\s{2,}(\d+)$", line)
+        if g:
+            res[g.group(1)] = int(g.group(2))
+    return res
+
+def write_ccache_stats(dfn, before):
+    """Save how the counters changed during this run"""
+    after = ccache_stats()
+    with open(os.path.join(dfn, "ccache-stats.txt"), "w") as F:
+        for k, v in after.items():
+            F.write("%-40s %d\n" %(k, v - before.get(k, 0)))
+
+def build_dir(args, config, cc=None, extra=None):
+    """Return the object directory used to build the tree with the given
+    kconfig target. The directory is configured on first use and kept for
+    the whole CI run, so every checker that needs the same configuration
+    shares the objects and make only rebuilds what was changed in between.
+    Builds with different compilers or compiler flags get their own
+    directory, otherwise kbuild would rebuild everything on every switch."""
+    name = config
+    if cc:
+        name += "-" + os.path.basename(cc)
+    if extra:
+        name += "-" + extra
+    odir = os.path.join("/build/obj", name)
+    if not os.path.isdir(odir):
+        os.makedirs(odir)
+        if config in args.fragments:
+            target = ["KCONFIG_ALLCONFIG=%s" %(args.fragments[config]), "allnoconfig"]
+        else:
+            target = [config]
+        subprocess.call(make_cmd(args, odir, cc) + target)
+    return odir
+
+kbuild_re = re.compile(r"^\s*([\w.-]+)-(?:y|objs|\$\(CONFIG_(\w+)\))\s*[:+]?=(.*)$")
+
+def kbuild_symbols(d, names, seen):
+    """Return the CONFIG symbols of the Makefile lines in directory d that
+    build one of names. Objects linked into a composite object bring in the
+    symbols of that object as well."""
+    res = set()
+    for mk in ("Kbuild", "Makefile"):
         try:
-            if l[0] not in args.files:
-                continue
-            if not l[1].isdigit():
+            with open(os.path.join(d, mk)) as F:
+                lines = F.read().replace("\\\n", " ").split("\n")
+        except FileNotFoundError:
+            continue
+        for line in lines:
+            g = kbuild_re.match(line)
+            if not g or not names.intersection(g.group(3).split()):
                 continue
-        except IndexError:
-            if not l:
-                print(line)
+            if g.group(2):
+                res.add(g.group(2))
+            composite = g.group(1) + ".o"
+            if g.group(1) not in ("obj", "lib", "subdir") and composite not in seen:
+                seen.add(composite)
+                res |= kbuild_symbols(d, {composite}, seen)
+    return res
+
+def target_symbols(target):
+    """Return the CONFIG symbols needed for kbuild to descend to target"""
+    res = set()
+    path = target.rstrip("/")
+    parts = [target]
+    while "/" in path:
+        path = os.path.dirname(path)
+        # Makefiles may name a subdirectory more than one level down
+        names = set(os.path.relpath(I, path) + ("/" if I.endswith("/") else "")
+                    for I in parts)
+        res |= kbuild_symbols(path, names, set())
+        parts.append(path + "/")
+    return res
+
+kconfig_re = re.compile(r"^\s*(menuconfig|config|depends on|if|endif|menu|endmenu|choice|"
+                        r"endchoice|comment|source|bool|tristate|def_bool|def_tristate|"
+                        r"help|---help---)(?:\s+(.*))?$")
+
+def kconfig_symbols(expr):
+    """The symbols an expression needs to be enabled, negated ones and the
+    ones inside macros and strings are left out"""
+    expr = re.sub(r'\$\(.*\)|"[^"]*"', "", expr or "")
+    return set(re.findall(r"(?<![!\w])([A-Z][A-Z0-9_]*)\b", expr))
+
+def kconfig_deps(args):
+    """Parse the x86 Kconfig files, return the symbols each boolean symbol
+    depends on, including the dependencies of the enclosing if, menu and
+    choice blocks"""
+    files = subprocess.check_output(["git", "ls-files", "-z", "--", "*Kconfig*"]).decode()
+    deps = collections.defaultdict(set)
+    boolean = set()
+    for fn in files.split("\0"):
+        if not fn or fn.startswith("arch/") and not fn.startswith("arch/x86/"):
             continue
-        blame = subprocess.check_output(["git", "blame", l[0], "-L%s,%s" %(l[1], l[1]), "-l", "-s"])
-        blame = blame.split()[0]
-        if args.rev == blame:
+        with open(fn, errors='replace') as F:
+            lines = F.read().replace("\\\n", " ").split("\n")
+        blocks = []
+        cur = None
+        name = None
+        help_indent = None
+        for line in lines:
+            indent = len(line.expandtabs()) - len(line.expandtabs().lstrip())
+            if help_indent is not None:
+                if not line.strip() or indent > help_indent:
+                    continue
+                help_indent = None
+            g = kconfig_re.match(line)
+            if not g:
+                continue
+            kw, rest = g.groups()
+            if kw in ("config", "menuconfig"):
+                name = rest.split()[0]
+                cur = deps[name]
+                for I in blocks:
+                    cur.update(I)
+            elif kw == "depends on":
+                if cur is not None:
+                    cur.update(kconfig_symbols(rest))
+            elif kw in ("bool", "tristate", "def_bool", "def_tristate"):
+                if name:
+                    boolean.add(name)
+            elif kw == "if":
+                blocks.append(kconfig_symbols(rest))
+                cur = name = None
+            elif kw in ("menu", "choice"):
+                cur = set()
+                blocks.append(cur)
+                name = None
+            elif kw in ("endif", "endmenu", "endchoice"):
+                if blocks:
+                    blocks.pop()
+                cur = name = None
+            elif kw in ("comment", "source"):
+                cur = name = None
+            else:
+                help_indent = indent
+    return {k: v for k, v in deps.items() if k in boolean}
+
+def minimal_config(args):
+    """Return the kconfig target to build the series with. Unless the
+    exhaustive mode was asked for, this is an allnoconfig with only the
+    symbols needed to build the targets of all the commits and their Kconfig
+    dependencies enabled, which configures and builds in a fraction of the
+    allyesconfig time. allyesconfig is used when the generated config does
+    not enable everything that was asked for."""
+    if args.exhaustive:
+        return "allyesconfig"
+
+    deps = kconfig_deps(args)
+    required = set()
+    for target in args.targets:
+        required |= target_symbols(target)
+    required = set(I for I in required if I in deps)
+    # allnoconfig of x86 is an i386 config, the other configs are 64 bit
+    required.add("64BIT")
+    need = set(required)
+    todo = list(required)
+    while todo:
+        for I in deps[todo.pop()]:
+            if I in deps and I not in need:
+                need.add(I)
+                todo.append(I)
+
+    fragment = "".join("CONFIG_%s=y\n" %(I) for I in sorted(need))
+    config = "minconfig-" + hashlib.sha256(fragment.encode()).hexdigest()[:12]
+    fn = os.path.join("/build", config + ".fragment")
+    with open(fn, "w") as F:
+        F.write(fragment)
+    args.fragments[config] = fn
+
+    odir = build_dir(args, config)
+    with open(os.path.join(odir, ".config")) as F:
+        enabled = set(re.findall(r"^CONFIG_(\w+)=y$", F.read(), re.M))
+    missing = required - enabled
+    if missing:
+        print("Minimal config does not enable %s, using allyesconfig"
+              %(" ".join("CONFIG_" + I for I in sorted(missing))))
+        shutil.rmtree(odir)
+        return "allyesconfig"
+    return config
+
+def strip_srctree(args, text):
+    """Out of tree builds report the absolute path of the sources, convert
+    it back to the path relative to the top of the tree"""
+    return text.replace(os.path.join(args.src, ''), '')
+
+class Diagnostic(collections.namedtuple(
+        "Diagnostic", "file line col tool severity message text context prefix",
+        defaults=((),))):
+    """A single finding reported by a compiler or a checker. text is the
+    original report line, context the lines printed after it, like code
+    snippets or the expected/got explanation of sparse, and prefix the lines
+    printed before it, like the function or include chain gcc names."""
+    @property
+    def key(self):
+        """The identity of the finding, used for dedup and baseline
+        subtraction"""
+        return self[:6]
+
+diag_re = re.compile(r"^(?P<file>[^:\s]+):(?P<line>\d+):(?:(?P<col>\d+):)?\s*"
+                     r"(?:(?P<tool>sparse):\s*)?"
+                     r"(?P<severity>fatal error|error|warning|note):\s*(?P<msg>.*)$")
+smatch_re = re.compile(r"^(?P<file>[^:\s]+):(?P<line>\d+) \S+ "
+                       r"(?P<severity>warn|error|info): (?P<msg>.*)$")
+checkpatch_re = re.compile(r"^(?P<severity>WARNING|ERROR|CHECK): (?P<msg>.*)$")
+checkpatch_loc_re = re.compile(r"^#\d+: FILE: (?P<file>[^:]+):(?P<line>\d+):")
+# Lines gcc and clang print before a report to say where it comes from
+prefix_re = re.compile(r"^(?:\S+: (?:In |At top level:)|In file included from |In function )")
+prefix_cont_re = re.compile(r"^\s+(?:from|inlined from) ")
+
+severities = {
+    "fatal error": "error",
+    "warn": "warning",
+    "info": "note",
+    "WARNING": "warning",
+    "ERROR": "error",
+    "CHECK": "note",
+}
+
+class DiagnosticParser(object):
+    """Incrementally split the output of tool into Diagnostic records. Lines
+    that are not a report on their own are attached as context to the record
+    before them, except for the function and include chain lines gcc prints
+    before a report, which are its prefix. Lines before the first report form
+    a record without a location. A record is complete once the next one
+    starts or the output is closed."""
+    def __init__(self, tool):
+        self.tool = tool
+        self.cur = None
+        self.prefix = []
+
+    def _finish(self):
+        cur = self.cur
+        self.cur = None
+        if cur is None:
+            return []
+        return [Diagnostic(**dict(cur, context=tuple(cur["context"]),
+                                  prefix=tuple(cur["prefix"])))]
+
+    def _flush_prefix(self):
+        """The prefix lines were not followed by a report after all"""
+        prefix = self.prefix
+        self.prefix = []
+        for line in prefix:
+            self._add_context(line)
+
+    def _add_context(self, line):
+        if self.cur is None:
+            self.cur = dict(file=None, line=None, col=None, tool=self.tool,
+                            severity=None, message=None, text=line, context=[],
+                            prefix=[])
+        else:
+            self.cur["context"].append(line)
+
+    def feed(self, line):
+        """Add one line of output, returns the records it completed"""
+        if self.tool == "checkpatch":
+            g = checkpatch_re.match(line)
+        elif self.tool == "smatch":
+            g = smatch_re.match(line) or diag_re.match(line)
+        else:
+            g = diag_re.match(line)
+
+        cur = self.cur
+        if g is None:
+            if not line and self.tool != "checkpatch":
+                return []
+            if self.tool != "checkpatch" and (prefix_re.match(line) or
+                                              self.prefix and prefix_cont_re.match(line)):
+                self.prefix.append(line)
+                return []
+            self._flush_prefix()
+            if cur is None:
+                self._add_context(line)
+                return []
+            loc = checkpatch_loc_re.match(line)
+            if loc and cur["file"] is None and cur["severity"]:
+                cur["file"] = loc.group("file")
+                cur["line"] = int(loc.group("line"))
+            cur["context"].append(line)
+            return []
+
+        res = self._finish()
+        d = g.groupdict()
+        self.cur = dict(file=d.get("file"),
+                        line=int(d["line"]) if d.get("line") else None,
+                        col=int(d["col"]) if d.get("col") else None,
+                        tool=d.get("tool") or self.tool,
+                        severity=severities.get(d["severity"], d["severity"]),
+                        message=" ".join(d["msg"].split()),
+                        text=line, context=[], prefix=self.prefix)
+        self.prefix = []
+        return res
+
+    def close(self):
+        self._flush_prefix()
+        return self._finish()
+
+def parse_diagnostics(lines, tool):
+    """Generate the Diagnostic records found in an iterable of lines"""
+    parser = DiagnosticParser(tool)
+    for line in lines:
+        yield from parser.feed(line.rstrip('\n'))
+    yield from parser.close()
+
+class FailFast(Exception):
+    """Raised by Report.add at the first new finding of a check with fail_fast"""
+
+class Report(object):
+    """Collect everything reported by the CI run, per checked commit, so that
+    it can be summarized and saved in a machine readable form next to the
+    printed output"""
+    def __init__(self):
+        self.revs = collections.OrderedDict()
+        self.rev = None
+        # Set by run_checks while a check runs with fail_fast
+        self.fail_fast = False
+
+    def start(self, rev):
+        """Findings added from now on belong to rev"""
+        self.rev = rev.decode()
+        self.revs[self.rev] = []
+
+    def add(self, check, diag, new=True):
+        """Report diag, new is False for findings the commit may not have
+        introduced, those never stop a check with fail_fast"""
+        for line in diag.prefix:
+            print(line)
+        print(diag.text)
+        for line in diag.context:
             print(line)
+        self.revs[self.rev].append((check, diag))
+        if self.fail_fast and diag.severity and new:
+            raise FailFast()
+
+    def current(self):
+        """Everything reported for the current commit"""
+        return self.revs[self.rev]
+
+    def findings(self, rev):
+        return [I for I in self.revs[rev] if I[1].severity]
+
+    def summary(self, cwd=None):
+        print("\nSummary:")
+        for rev in self.revs:
+            subject = subprocess.check_output(
+                ["git", "log", "-n1", "--format=%h %s", rev], cwd=cwd).decode().strip()
+            print("  %s: %d finding(s)" %(subject, len(self.findings(rev))))
+
+    def as_json(self):
+        commits = []
+        for rev in self.revs:
+            res = []
+            for check, diag in self.findings(rev):
+                d = diag._asdict()
+                d["check"] = check
+                d["context"] = list(diag.context)
+                d["prefix"] = list(diag.prefix)
+                res.append(d)
+            commits.append({"rev": rev, "findings": res})
+        return {"commits": commits}
+
+    def as_sarif(self):
+        runs = collections.OrderedDict()
+        for rev in self.revs:
+            for check, diag in self.findings(rev):
+                res = {"level": diag.severity, "message": {"text": diag.message},
+                       "properties": {"rev": rev, "check": check}}
+                if diag.file:
+                    region = {"startLine": diag.line}
+                    if diag.col:
+                        region["startColumn"] = diag.col
+                    res["locations"] = [{"physicalLocation": {
+                        "artifactLocation": {"uri": diag.file},
+                        "region": region}}]
+                runs.setdefault(diag.tool, []).append(res)
+        return {
+            "version": "2.1.0",
+            "$schema": "https://json.schemastore.org/sarif-2.1.0.json",
+            "runs": [{"tool": {"driver": {"name": tool}}, "results": results}
+                     for tool, results in runs.items()],
+        }
+
+    def write(self, dfn):
+        """Save the report as JSON and SARIF into the logs directory"""
+        with open(os.path.join(dfn, "ci-report.json"), "w") as F:
+            json.dump(self.as_json(), F, indent=2)
+        with open(os.path.join(dfn, "ci-report.sarif"), "w") as F:
+            json.dump(self.as_sarif(), F, indent=2)
 
-def smatch_and_sparse(args, tool):
-    if tool == "smatch":
-        tool_cmd = ["CHECK=/opt/smatch/bin/smatch -p=kernel --data=/opt/smatch/share/smatch/smatch_data/",
-                "C=1"]
-    if tool == "sparse":
-        tool_cmd = ["CHECK=sparse", "C=1", "CF='-fdiagnostic-prefix -D__CHECK_ENDIAN__'"]
-
-    base_cmd = ["make", "-j", str(args.num_jobs), "-s"]
-    subprocess.call(base_cmd + ["clean"])
-    subprocess.call(base_cmd + ["allyesconfig"])
-    cmd = base_cmd + tool_cmd + args.dirlist
+class ResultCache(object):
+    """Verdicts of previous CI runs, keyed by the patch-id and the message of
+    the commit together with the toolchain and the selected checks, so that
+    a rebased commit with the same diff is not checked again"""
+    def __init__(self, args):
+        self.dfn = "/ci-cache" if os.path.isdir("/ci-cache") else None
+        opts = [args.project, args.image_id or ""]
+        for I in ("checkpatch", "sparse", "gerrit", "show_all", "warnings", "smatch", "clang",
+                  "fast_clang", "exhaustive"):
+            opts.append("%s=%s" %(I, getattr(args, I)))
+        self.opts = "\0".join(opts)
+
+    def key(self, rev, cwd):
+        if self.dfn is None:
+            return None
+        diff = subprocess.check_output(["git", "show", rev], cwd=cwd)
+        pid = subprocess.run(["git", "patch-id", "--stable"], input=diff,
+                             stdout=subprocess.PIPE, cwd=cwd).stdout.split()
+        if not pid:
+            return None
+        msg = subprocess.check_output(["git", "log", "-n1", "--format=%B", rev], cwd=cwd)
+        return hashlib.sha256(b"\0".join([pid[0], msg, self.opts.encode()])).hexdigest()
+
+    def _fn(self, key):
+        return os.path.join(self.dfn, key + ".json")
+
+    def has(self, key):
+        return key is not None and os.path.exists(self._fn(key))
+
+    def replay(self, key, report):
+        """Report the stored result, returns False if there is none"""
+        if key is None:
+            return False
+        try:
+            with open(self._fn(key)) as F:
+                res = json.load(F)
+            os.utime(self._fn(key))
+        except (FileNotFoundError, ValueError):
+            return False
+        print("Same patch was already checked, showing the cached result (use --force to check again)")
+        for check, d in res:
+            report.add(check, Diagnostic(**dict(d, context=tuple(d["context"]),
+                                                prefix=tuple(d.get("prefix", ())))))
+        return True
+
+    def save(self, key, reported):
+        if key is None:
+            return
+        fn = self._fn(key)
+        with open(fn + ".tmp", "w") as F:
+            json.dump([(check, diag._asdict()) for check, diag in reported], F)
+        os.rename(fn + ".tmp", fn)
+
+class Attribution(object):
+    """Index of the lines introduced by a commit. It is built from a single
+    "git show -U0" of the commit and answers the same question as running git
+    blame on a line and comparing the result with the commit, without a git
+    process per reported line."""
+    def __init__(self, rev):
+        self.ranges = collections.defaultdict(list)
+        diff = subprocess.check_output(["git", "show", "-U0", "--format=",
+                                        "--no-color", rev])
+        fn = None
+        for line in diff.splitlines():
+            if line.startswith(b"+++ "):
+                fn = line[4:]
+                fn = None if fn == b"/dev/null" else fn[2:].decode()
+                continue
+            if fn is None:
+                continue
+            g = re.match(rb"@@ -\S+ \+(\d+)(?:,(\d+))? @@", line)
+            if g is None:
+                continue
+            start = int(g.group(1))
+            count = 1 if g.group(2) is None else int(g.group(2))
+            if count:
+                self.ranges[fn].append((start, start + count - 1))
+
+    def introduced(self, fn, lineno):
+        """True if line lineno of file fn was added by the commit"""
+        ranges = self.ranges.get(fn)
+        if not ranges:
+            return False
+        # Hunks are reported in file order, so the ranges are sorted
+        idx = bisect.bisect_right(ranges, (lineno, sys.maxsize)) - 1
+        return idx >= 0 and ranges[idx][0] <= lineno <= ranges[idx][1]
+
+def introduced(args, diag):
+    """True if diag points to a line added by the commit under test"""
+    if diag.file not in args.files or diag.line is None:
+        return False
+    return args.attribution.introduced(diag.file, diag.line)
+
+def start_cmd(cmd, **kwargs):
+    """Start cmd in its own process group, so kill_cmd() also stops the jobs
+    make started"""
+    return subprocess.Popen(cmd, preexec_fn=os.setpgrp, **kwargs)
+
+def kill_cmd(proc):
+    if proc.poll() is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    proc.wait()
+
+def follow(args, procs, logs):
+    """Generate (name, line) for every line appended to the files in logs
+    while any of procs is still running. Reading the output while it is
+    produced keeps the memory use flat and shows findings immediately."""
+    handles = dict()
+    partial = collections.defaultdict(str)
+    while True:
+        running = any(I.poll() is None for I in procs)
+        got = False
+        for name, fn in logs.items():
+            if name not in handles:
+                try:
+                    handles[name] = open(fn, encoding='utf-8', errors='replace')
+                except FileNotFoundError:
+                    continue
+            data = handles[name].read()
+            if not data:
+                continue
+            got = True
+            lines = (partial[name] + data).split('\n')
+            partial[name] = lines.pop()
+            for line in lines:
+                yield name, strip_srctree(args, line)
+        if not running:
+            break
+        if not got:
+            time.sleep(0.2)
+
+    for name, F in handles.items():
+        if partial[name]:
+            yield name, strip_srctree(args, partial[name])
+        F.close()
+
+def follow_diagnostics(args, procs, logs, tools):
+    """Like follow() but generate (name, Diagnostic) using the parser for
+    the tool that writes each log"""
+    parsers = {name: DiagnosticParser(tools[name]) for name in logs}
+    for name, line in follow(args, procs, logs):
+        for diag in parsers[name].feed(line):
+            yield name, diag
+    for name, parser in parsers.items():
+        for diag in parser.close():
+            yield name, diag
+
+def stream_cmd(args, cmd, tool, stream="stderr", env=None):
+    """Run cmd and generate the Diagnostic records from its output as it is
+    printed"""
+    std = {stream: subprocess.PIPE}
+    with start_cmd(cmd, encoding='utf-8', errors='replace', env=env, **std) as proc:
+        try:
+            lines = (strip_srctree(args, I) for I in getattr(proc, stream))
+            yield from parse_diagnostics(lines, tool)
+        finally:
+            # Closed early when fail_fast stops the check
+            kill_cmd(proc)
+
+def cache_dir(name):
+    """Return a directory on the shared ccache volume to keep data between CI
+    runs, None if no such volume is configured"""
+    if not os.path.isdir("/ccache"):
+        return None
+    dfn = os.path.join("/ccache", "mkt-ci", name)
+    os.makedirs(dfn, exist_ok=True)
+    return dfn
+
+def prune_cache(dfn, days):
+    """Remove the entries of a cache directory that were not used for days.
+    Entries are touched when they are used. Walking a large cache takes a
+    while, so it is done at most once a day."""
+    if dfn is None:
+        return
+    stamp = os.path.join(dfn, ".pruned")
+    try:
+        if time.time() - os.path.getmtime(stamp) < 24 * 60 * 60:
+            return
+    except FileNotFoundError:
+        pass
+    open(stamp, "w").close()
+    for root, dirs, files in os.walk(dfn):
+        for I in files:
+            fn = os.path.join(root, I)
+            try:
+                if time.time() - os.path.getmtime(fn) > days * 24 * 60 * 60:
+                    os.unlink(fn)
+            except FileNotFoundError:
+                pass
+
+class BaselineCache(object):
+    """Findings of the parent commit, saved per checker so the next commit on
+    the same parent does not have to build and check it again. The results
+    depend on the parent commit, the checker, the kernel config, the checked
+    directories and the toolchain in the CI image. smatch findings also
+    depend on the generation of its cross function database."""
+    def __init__(self, args, config, targets):
+        self.dfn = cache_dir("baseline")
+        self.base = subprocess.check_output(
+            ["git", "rev-parse", args.rev.decode() + "~1"]).strip().decode()
+        self.parts = [config, args.image_id or "", " ".join(sorted(targets))]
+        smatch_db = getattr(args, "smatch_db", None)
+        self.smatch_gen = smatch_db.generation() if smatch_db else ""
+
+    def _fn(self, tool):
+        key = "\0".join([self.base, tool] + self.parts)
+        if tool == "smatch":
+            key += "\0" + self.smatch_gen
+        return os.path.join(self.dfn, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+    def load(self, tool):
+        if self.dfn is None:
+            return None
+        try:
+            with open(self._fn(tool)) as F:
+                res = set(tuple(I) for I in json.load(F))
+            os.utime(self._fn(tool))
+            return res
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, tool, keys):
+        if self.dfn is None:
+            return
+        fn = self._fn(tool)
+        with open(fn + ".tmp", "w") as F:
+            json.dump(sorted(keys, key=repr), F)
+        os.rename(fn + ".tmp", fn)
+
+def parse_cmd_file(args, fn):
+    """Return the source and the headers it includes from a kbuild .cmd
+    file"""
+    src = None
+    hdrs = set()
+    in_deps = False
+    with open(fn, errors='replace') as F:
+        for line in F:
+            if line.startswith("source_"):
+                src = strip_srctree(args, line.partition(":=")[2].strip())
+            elif line.startswith("deps_"):
+                in_deps = True
+            elif in_deps:
+                item = line.strip().rstrip("\\").strip()
+                if item.endswith(".h") and not item.startswith("$("):
+                    hdrs.add(strip_srctree(args, item))
+                if not line.rstrip().endswith("\\"):
+                    in_deps = False
+    if src is None or not src.endswith(".c"):
+        return None, None
+    return src, hdrs
+
+class DepsIndex(object):
+    """Reverse dependency index from a header to the sources that include it.
+    It is built from the .cmd files kbuild leaves in the object directories
+    and kept per source tree on the ccache volume, so every CI run adds what
+    it has built."""
+    def __init__(self, args):
+        self.db = None
+        dfn = cache_dir("deps")
+        if dfn is None:
+            return
+        key = hashlib.sha256(args.tree.encode()).hexdigest()
+        self.db = sqlite3.connect(os.path.join(dfn, key + ".sqlite"), timeout=60)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS deps (src TEXT, hdr TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS deps_hdr ON deps (hdr)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS deps_src ON deps (src)")
+
+    def users(self, hdr):
+        """Return the sources known to include hdr, None if there are none"""
+        if self.db is None:
+            return None
+        rows = self.db.execute("SELECT DISTINCT src FROM deps WHERE hdr = ?", (hdr,))
+        return set(I[0] for I in rows) or None
+
+    def exact(self, hdr):
+        """True if users() returns all the sources that include hdr. The
+        index only has the sources the CI built, with the configs it used,
+        and a shared header can be included from anywhere in the tree, so
+        only the users of a header next to its sources are known. Those are
+        in the directory of the header, which is checked anyway."""
+        if self.db is None:
+            return False
+        return not (hdr.startswith(("include/", "arch/")) or "/include/" in hdr)
+
+    def headers(self, targets):
+        """Return the headers in the tree included by the sources of the make
+        targets"""
+        res = set()
+        if self.db is None:
+            return res
+        for I in targets:
+            prefix = I[:-2] + ".c" if I.endswith(".o") else I
+            rows = self.db.execute("SELECT DISTINCT hdr FROM deps WHERE substr(src, 1, ?) = ?",
+                                   (len(prefix), prefix))
+            res.update(row[0] for row in rows if not row[0].startswith("/"))
+        return res
+
+    def update(self, args):
+        """Parse the .cmd files written since the last update of each object
+        directory and replace the dependencies of their sources"""
+        if self.db is None:
+            return
+        deps = collections.defaultdict(set)
+        for odir in glob.glob("/build/obj/*/"):
+            stamp = os.path.join(odir, ".mkt-deps")
+            try:
+                since = os.stat(stamp).st_mtime
+            except FileNotFoundError:
+                since = 0
+            start = time.time()
+            for root, dirs, files in os.walk(odir):
+                for fn in files:
+                    if not fn.startswith(".") or not fn.endswith(".o.cmd"):
+                        continue
+                    fn = os.path.join(root, fn)
+                    if os.stat(fn).st_mtime < since:
+                        continue
+                    src, hdrs = parse_cmd_file(args, fn)
+                    if src is not None:
+                        # Different configs include different headers
+                        deps[src].update(hdrs)
+            with open(stamp, "w"):
+                pass
+            os.utime(stamp, (start, start))
+
+        with self.db:
+            for src, hdrs in deps.items():
+                self.db.execute("DELETE FROM deps WHERE src = ?", (src,))
+                self.db.executemany("INSERT INTO deps VALUES (?, ?)",
+                                    ((src, I) for I in hdrs))
+
+class SmatchDB(object):
+    """Per tree smatch cross function database kept on the ccache volume.
+    Building it for the whole tree takes hours, instead every CI run checks
+    with the current database and then loads what smatch learned about the
+    checked units into it, so it becomes more complete with every run."""
+    scripts = "/opt/smatch/share/smatch/smatch_data/db/"
+
+    def __init__(self, args):
+        self.info = "/build/smatch-info"
+        key = hashlib.sha256(args.tree.encode()).hexdigest()
+        self.dfn = cache_dir(os.path.join("smatch", key))
+
+    def generation(self):
+        """Changes every time the database is reloaded, results of smatch
+        are only valid for the same generation"""
+        if self.dfn is None:
+            return ""
+        try:
+            with open(os.path.join(self.dfn, "generation")) as F:
+                return F.read().strip()
+        except FileNotFoundError:
+            return ""
+
+    def env(self):
+        """Environment for do-check.py to use and update the database"""
+        if self.dfn is None:
+            return {}
+        os.makedirs(self.info, exist_ok=True)
+        res = {"MKT_SMATCH_INFO": self.info}
+        db = os.path.join(self.dfn, "smatch_db.sqlite")
+        if os.path.exists(db):
+            res["MKT_SMATCH_DB"] = db
+            res["MKT_SMATCH_DB_GEN"] = self.generation()
+        return res
+
+    def update(self):
+        infos = glob.glob(os.path.join(self.info, "*.info"))
+        if self.dfn is None or not infos:
+            return
+        with open(os.path.join(self.dfn, "lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            db = os.path.join(self.dfn, "smatch_db.sqlite")
+            # What was loaded for every unit, only what smatch learned anew
+            # is reloaded
+            loaded_fn = os.path.join(self.dfn, "loaded.json")
+            loaded = dict()
+            if os.path.exists(db):
+                try:
+                    with open(loaded_fn) as F:
+                        loaded = json.load(F)
+                except (FileNotFoundError, ValueError):
+                    pass
+            changed = []
+            for fn in infos:
+                with open(fn, "rb") as F:
+                    h = hashlib.sha256(F.read()).hexdigest()
+                if loaded.get(os.path.basename(fn)) != h:
+                    loaded[os.path.basename(fn)] = h
+                    changed.append(fn)
+            if changed:
+                warns = os.path.join("/build", "smatch-warns.txt")
+                with open(warns, "wb") as out:
+                    for fn in changed:
+                        with open(fn, "rb") as F:
+                            shutil.copyfileobj(F, out)
+                script = "reload_partial.sh" if os.path.exists(db) else "create_db.sh"
+                subprocess.call([self.scripts + script, "-p=kernel", warns], cwd=self.dfn,
+                                stdout=subprocess.DEVNULL)
+                # Cached smatch results of the previous database are stale
+                with open(os.path.join(self.dfn, "generation"), "w") as F:
+                    F.write(os.urandom(8).hex())
+                with open(loaded_fn + ".tmp", "w") as F:
+                    json.dump(loaded, F)
+                os.rename(loaded_fn + ".tmp", loaded_fn)
+        shutil.rmtree(self.info)
+
+def run_checkers(args, tools, odir, name):
+    """Make a single pass over the dirlist with every checker in tools run on
+    each translation unit through the do-check.py wrapper. Generates
+    (stream, Diagnostic) for the output of each checker and of the build
+    itself while make runs."""
+    check_dir = os.path.join("/build/check", name)
+    shutil.rmtree(check_dir, ignore_errors=True)
+    os.makedirs(check_dir)
+    env = dict(os.environ, MKT_CHECKERS=" ".join(tools), MKT_CHECK_DIR=check_dir)
+    cache = cache_dir("check")
+    if cache:
+        env["MKT_CHECK_CACHE"] = cache
+    if "smatch" in tools:
+        env.update(args.smatch_db.env())
+
+    logs = {I: os.path.join(check_dir, I + ".log") for I in tools}
+    logs["build"] = os.path.join(check_dir, "build.log")
+    stream_tools = {I: I for I in tools}
+    stream_tools["build"] = "gcc"
+
+    # C=2 checks all sources, even those already compiled by a previous
+    # checker in the shared object directory.
+    cmd = make_cmd(args, odir) + ["CHECK=python3 /plugins/do-check.py", "C=2"] + args.dirlist
+    with open(logs["build"], "w") as F:
+        proc = start_cmd(cmd, stdout=subprocess.DEVNULL, stderr=F, env=env)
+    try:
+        yield from follow_diagnostics(args, [proc], logs, stream_tools)
+    finally:
+        kill_cmd(proc)
+
+def static_checkers(args, tools):
+    odir = build_dir(args, args.config)
     if args.show_all:
-        subprocess.run(cmd)
+        for stream, diag in run_checkers(args, tools, odir, "rev"):
+            args.report.add(stream, diag)
         return
 
-    out = subprocess.run(cmd, encoding='utf-8', capture_output=True)
     if args.filter_by_diff:
-        subprocess.check_call(["git", "reset", "--hard", "-q", args.rev.decode() + "~1"])
-        subprocess.call(base_cmd + ["clean"])
-        subprocess.call(base_cmd + ["allyesconfig"])
+        # Collect the baseline first so new findings of the commit can be
+        # printed as soon as they are found
+        cache = BaselineCache(args, args.config, args.dirlist)
+        base = dict()
+        for tool in tools:
+            keys = cache.load(tool)
+            if keys is not None:
+                base[tool] = keys
 
-        pre = subprocess.run(cmd, encoding='utf-8', capture_output=True)
-        diff = list(set(out.stderr.split('\n')) - set(pre.stderr.split('\n')))
-        # Restore
-        subprocess.check_call(["git", "reset", "--hard", "-q", args.rev])
-        for line in diff:
-            print(line)
+        missing = [I for I in tools if I not in base]
+        if missing:
+            subprocess.check_call(["git", "reset", "--hard", "-q", args.rev.decode() + "~1"])
+            found = {I: set() for I in missing + ["build"]}
+            for stream, diag in run_checkers(args, missing, odir, "base"):
+                found[stream].add(diag.key)
+            # Restore
+            subprocess.check_call(["git", "reset", "--hard", "-q", args.rev])
+            for tool in missing:
+                cache.save(tool, found[tool])
+            base.update(found)
+
+        for stream, diag in run_checkers(args, tools, odir, "rev"):
+            if not diag.severity:
+                continue
+            # The compiler output depends on what make had to rebuild and is
+            # not cached, without a baseline fall back to the commit's lines.
+            if stream not in base:
+                if introduced(args, diag):
+                    args.report.add(stream, diag)
+            elif diag.key not in base[stream]:
+                args.report.add(stream, diag)
+    else:
+        for stream, diag in run_checkers(args, tools, odir, "rev"):
+            if introduced(args, diag):
+                args.report.add(stream, diag)
+
+# gcc options clang does not understand, matched by prefix
+gcc_only = ("-Wp,-MMD", "-fno-var-tracking-assignments", "-fconserve-stack",
+            "-mindirect-branch", "-mpreferred-stack-boundary", "-falign-jumps",
+            "-falign-loops", "-fno-allow-store-data-races", "-mrecord-mcount",
+            "-fplugin", "-fno-ipa-", "-mskip-rax-setup", "-fno-code-hoisting",
+            "-fno-inline-functions-called-once", "-Wimplicit-fallthrough=")
+
+def compile_commands(args, odir):
+    """Generate the compile_commands.json entries for the units of the
+    targets from the .cmd files of a gcc build. Returns None if one of the
+    targets was not built there or has no C units to check."""
+    res = []
+    for target in args.dirlist:
+        num = len(res)
+        if target.endswith(".o"):
+            cmds = [os.path.join(odir, os.path.dirname(target),
+                                 "." + os.path.basename(target) + ".cmd")]
+            if not os.path.exists(cmds[0]):
+                return None
+        else:
+            cmds = glob.glob(os.path.join(odir, target, "**", ".*.o.cmd"), recursive=True)
+        for fn in cmds:
+            src = None
+            cmd = None
+            with open(fn, errors='replace') as F:
+                for line in F:
+                    if line.startswith("cmd_"):
+                        cmd = line.partition(":=")[2].strip()
+                    elif line.startswith("source_"):
+                        src = line.partition(":=")[2].strip()
+            if cmd and src and src.endswith(".c"):
+                # Undo the make escaping of the .cmd files
+                cmd = cmd.replace("\\#", "#").replace("$$", "$")
+                res.append({"directory": odir, "file": src, "command": cmd})
+        if len(res) == num:
+            return None
+    return res
+
+def clang_cmd(entry):
+    """Convert a gcc command into a clang -fsyntax-only one"""
+    argv = shlex.split(entry["command"])
+    if os.path.basename(argv[0]) == "ccache":
+        argv = argv[1:]
+    res = ["/opt/llvm/bin/clang", "-fsyntax-only", "-Qunused-arguments",
+           "-Wno-unknown-warning-option"]
+    itr = iter(argv[1:])
+    for I in itr:
+        if I == "-o":
+            next(itr, None)
+        elif I == "-c" or I.startswith(gcc_only):
+            continue
+        else:
+            res.append(I)
+    return res
+
+def clang_fast(args):
+    """Run clang -fsyntax-only on the affected units with the flags of the
+    gcc build already done in this run. Returns False if there is no such
+    build covering all the targets."""
+    for name in (args.config, args.config + "-W1"):
+        odir = os.path.join("/build/obj", name)
+        if os.path.isdir(odir):
+            entries = compile_commands(args, odir)
+            if entries is not None:
+                break
     else:
-        print_filtered_output(args, out)
+        return False
+
+    with open(os.path.join(odir, "compile_commands.json"), "w") as F:
+        json.dump(entries, F, indent=2)
+
+    def run(entry):
+        out = subprocess.run(clang_cmd(entry), cwd=entry["directory"], encoding='utf-8',
+                             errors='replace', stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE)
+        return out.stderr
+
+    seen = set()
+    with concurrent.futures.ThreadPoolExecutor(args.num_jobs) as pool:
+        futures = [pool.submit(run, I) for I in entries]
+        try:
+            for fut in futures:
+                out = fut.result()
+                for diag in parse_diagnostics(strip_srctree(args, out).split('\n'), "clang"):
+                    # Headers are seen by many units
+                    if diag.severity:
+                        if diag.key in seen:
+                            continue
+                        seen.add(diag.key)
+                    args.report.add("clang", diag, introduced(args, diag))
+        except FailFast:
+            # Only the units already running are waited for
+            for fut in futures:
+                fut.cancel()
+            raise
+    return True
 
 def clang(args):
-    base_cmd = ["make", "-j", str(args.num_jobs), "-s", "CC=/opt/llvm/bin/clang"]
-    subprocess.call(base_cmd + ["clean"])
-    subprocess.call(base_cmd + ["allyesconfig"])
-    cmd = base_cmd + args.dirlist
-    subprocess.call(cmd);
+    if args.fast_clang and clang_fast(args):
+        return
+    odir = build_dir(args, args.config, cc="/opt/llvm/bin/clang")
+    cmd = make_cmd(args, odir, "/opt/llvm/bin/clang") + args.dirlist
+    for diag in stream_cmd(args, cmd, "clang"):
+        args.report.add("clang", diag, introduced(args, diag))
 
 def checkpatch(args):
     cmd = ["%s/scripts/checkpatch.pl" %(args.checkpatch_root_dir), "-q", "--no-summary", "-g", args.rev]
@@ -131,47 +1245,254 @@ def checkpatch(args):
 
     if args.gerrit:
         cmd += ["--ignore", "GERRIT_CHANGE_ID,FILE_PATH_CHANGES"]
-    subprocess.call(cmd);
+    for diag in stream_cmd(args, cmd, "checkpatch", "stdout"):
+        args.report.add("checkpatch", diag)
+
+def warnings_cmd(args, config, num_jobs=None):
+    odir = build_dir(args, config, extra="W1")
+    return make_cmd(args, odir, num_jobs=num_jobs) + ["W=1"] + args.dirlist
+
+def warnings_parallel(args, configs):
+    """Build all the configurations at the same time, each in its own object
+    directory with an equal share of the CPUs. The build output goes into
+    files so that none of the builds blocks on a full pipe. Generates
+    (config, Diagnostic), the records of the first config as they are found
+    and the others once all builds are done, so the merged output is the
+    same as in the serial mode."""
+    num_jobs = max(1, args.num_jobs // len(configs))
+    procs = []
+    logs = collections.OrderedDict()
+    for config in configs:
+        logs[config] = os.path.join("/build/obj", config + "-W1.stderr")
+        with open(logs[config], "w") as F:
+            procs.append(start_cmd(warnings_cmd(args, config, num_jobs),
+                                   stdout=subprocess.DEVNULL, stderr=F))
+
+    # Only unique records are kept, so the memory use is bounded by the
+    # number of distinct findings and not by the size of the output.
+    held = {I: collections.OrderedDict() for I in configs[1:]}
+    tools = {I: "gcc" for I in configs}
+    try:
+        for config, diag in follow_diagnostics(args, procs, logs, tools):
+            if config == configs[0]:
+                yield config, diag
+            else:
+                held[config].setdefault(diag.key if diag.severity else diag, diag)
+    finally:
+        for proc in procs:
+            kill_cmd(proc)
+    for config in configs[1:]:
+        for diag in held[config].values():
+            yield config, diag
+
+def warnings_serial(args, configs):
+    for config in configs:
+        for diag in stream_cmd(args, warnings_cmd(args, config), "gcc"):
+            yield config, diag
 
 def warnings(args):
-    base_cmd = ["make", "-j", str(args.num_jobs), "-s"]
-    subprocess.call(base_cmd + ["clean"])
-    subprocess.call(base_cmd + ["allyesconfig"])
-    cmd = base_cmd + ["W=1"] + args.dirlist
-    yes = subprocess.run(cmd, encoding='utf-8', capture_output=True)
-
-    subprocess.call(base_cmd + ["clean"])
-    subprocess.call(base_cmd + ["allnoconfig"])
-    no = subprocess.run(cmd, encoding='utf-8', capture_output=True)
-
-    subprocess.call(base_cmd + ["clean"])
-    subprocess.call(base_cmd + ["allmodconfig"])
-    mod = subprocess.run(cmd, encoding='utf-8', capture_output=True)
-
-    for line in yes.stderr.split('\n'):
-        if line.startswith("scripts") or line == '':
+    if args.exhaustive:
+        configs = ("allyesconfig", "allnoconfig", "allmodconfig")
+    else:
+        configs = (args.config,)
+    if args.parallel_warnings:
+        diags = warnings_parallel(args, configs)
+    else:
+        diags = warnings_serial(args, configs)
+
+    # Report every finding once, in the exhaustive mode the allnoconfig and
+    # allmodconfig builds only add what allyesconfig did not already show.
+    kdoc = ['warning: Function parameter or member',
+            'warning: Excess function parameter']
+    seen = set()
+    for config, diag in diags:
+        if diag.text.startswith("scripts"):
             # Fixup to https://lore.kernel.org/lkml/1521810279-6282-3-git-send-email-yamada.masahiro@socionext.com/
             continue
-        if args.show_all is False:
-            f = ['warning: Function parameter or member',
-                 'warning: Excess function parameter']
-            if any(x in line for x in f):
-                continue
-        print(line)
-    for line in no.stderr.split('\n'):
-        if line in yes.stderr.split('\n'):
-            continue
-        if line.startswith("scripts") or line == '':
+        if args.show_all is False and any(x in diag.text for x in kdoc):
             continue
-        print(line)
-    for line in mod.stderr.split('\n'):
-        if line in yes.stderr.split('\n'):
-            continue
-        if line in no.stderr.split('\n'):
+        if diag.severity:
+            if diag.key in seen:
+                continue
+            seen.add(diag.key)
+        args.report.add("warnings", diag, introduced(args, diag))
+
+class CheckHistory(object):
+    """Runtime and outcome of every check in the previous CI runs of the
+    tree, kept on the ccache volume"""
+    # Used until a check has run once, about how long each takes for a
+    # small commit
+    defaults = {"checkpatch": 10, "static": 600, "warnings": 900, "clang": 900}
+
+    def __init__(self, args):
+        self.fn = None
+        self.data = dict()
+        dfn = cache_dir("history")
+        if dfn is None:
+            return
+        key = hashlib.sha256(args.tree.encode()).hexdigest()
+        self.fn = os.path.join(dfn, key + ".json")
+        try:
+            with open(self.fn) as F:
+                self.data = json.load(F)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def runtime(self, check):
+        d = self.data.get(check)
+        return d["runtime"] if d else self.defaults.get(check, 600)
+
+    def signal(self, check):
+        """How likely the check is to find something, smoothed so a check is
+        never written off after a few clean runs"""
+        d = self.data.get(check, {"runs": 0, "found": 0})
+        return (d["found"] + 1) / (d["runs"] + 2)
+
+    def order(self, checks, after=None):
+        """Cheapest check per expected finding first. A check in after only
+        runs once the checks it lists are done."""
+        todo = sorted(checks, key=lambda I: self.runtime(I) / self.signal(I))
+        res = []
+        while todo:
+            name = next(I for I in todo
+                        if not any(J in todo for J in (after or {}).get(I, ())))
+            todo.remove(name)
+            res.append(name)
+        return res
+
+    def record(self, check, runtime, found):
+        d = self.data.setdefault(check, {"runs": 0, "found": 0, "runtime": runtime})
+        # Follow the tree as it grows, but don't jump on a single odd run
+        d["runtime"] = 0.7 * d["runtime"] + 0.3 * runtime
+        d["runs"] += 1
+        if found:
+            d["found"] += 1
+
+    def save(self):
+        if self.fn is None:
+            return
+        with open(self.fn + ".%d" %(os.getpid()), "w") as F:
+            json.dump(self.data, F)
+        os.rename(self.fn + ".%d" %(os.getpid()), self.fn)
+
+def run_checks(args, checks, after=None):
+    """Run the checks in the order of CheckHistory, stop at the first finding
+    with fail_fast and skip the checks that are not expected to finish within
+    the time budget. args.partial is set when not all the checks were run."""
+    history = CheckHistory(args)
+    start = time.time()
+    for name in history.order(checks.keys(), after):
+        if args.budget:
+            left = args.budget * 60 - (time.time() - start)
+            if history.runtime(name) > left:
+                print("Skipping %s, it usually takes %ds and %ds of the budget are left"
+                      %(name, history.runtime(name), max(0, left)))
+                args.partial = True
+                continue
+        before = len(args.report.findings(args.report.rev))
+        began = time.time()
+        runtime = None
+        args.report.fail_fast = args.fail_fast
+        try:
+            checks[name]()
+            runtime = time.time() - began
+        except FailFast:
+            # The generators of the check are closed once the exception is
+            # dropped, which kills the commands they run
+            pass
+        finally:
+            args.report.fail_fast = False
+        found = len(args.report.findings(args.report.rev)) - before
+        # An interrupted check says nothing about how long it takes
+        history.record(name, runtime or history.runtime(name), found)
+        if args.fail_fast and found:
+            print("Stopping after %s found issues, the remaining checks were not run" %(name))
+            args.partial = True
+            break
+    history.save()
+
+def plan_scratch(args):
+    """Keep the object directories in the /build tmpfs when they fit next to
+    the sources, otherwise put them on the ccache volume or in the logs
+    directory"""
+    args.scratch = None
+    obj = "/build/obj"
+    if os.path.islink(obj) and not os.path.exists(obj):
+        # The objects on disk of a previous run in the same container are gone
+        os.unlink(obj)
+    if os.path.exists(obj):
+        # Left by a previous run in the same container
+        return
+    # About the most the objects of the checked directories take
+    need = (24 if args.exhaustive else 4) * 2**30
+    disk = cache_dir("scratch")
+    if disk is None and os.path.isdir(args.logs):
+        disk = os.path.join(args.logs, "scratch")
+    if shutil.disk_usage("/build").free >= need or disk is None:
+        os.makedirs(obj)
+        return
+
+    # Leftovers of runs that did not finish. The containers that use a
+    # directory hold a lock on it, watch and worker containers keep their
+    # objects there for as long as they live.
+    for I in glob.glob(os.path.join(disk, "*")):
+        if I.endswith(".lock") or time.time() - os.path.getmtime(I) < 24 * 60 * 60:
             continue
-        if line.startswith("scripts") or line == '':
+        lock = lock_tree(I, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if lock is None:
             continue
-        print(line)
+        shutil.rmtree(I, ignore_errors=True)
+        os.unlink(I + ".lock")
+        lock.close()
+    args.scratch = os.path.join(disk, socket.gethostname())
+    lock = lock_tree(args.scratch, fcntl.LOCK_SH)
+    subprocess.Popen(["sleep", "infinity"], pass_fds=[lock.fileno()],
+                     start_new_session=True)
+    lock.close()
+    os.makedirs(args.scratch, exist_ok=True)
+    os.utime(args.scratch)
+    os.symlink(args.scratch, obj)
+    print("Not enough memory for the objects, building them in %s" %(args.scratch))
+
+def tree_size(dfn):
+    res = 0
+    for root, dirs, files in os.walk(dfn):
+        for I in files:
+            try:
+                res += os.lstat(os.path.join(root, I)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return res
+
+class ScratchUsage(threading.Thread):
+    """Sample the use of the /build tmpfs and the memory available during the
+    run, to see how close it got to running out of either"""
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.done = threading.Event()
+        self.peak = 0
+        self.min_avail = None
+
+    def run(self):
+        while not self.done.wait(1):
+            self.peak = max(self.peak, shutil.disk_usage("/build").used)
+            with open("/proc/meminfo") as F:
+                for line in F:
+                    if line.startswith("MemAvailable:"):
+                        avail = int(line.split()[1]) * 1024
+                        if self.min_avail is None or avail < self.min_avail:
+                            self.min_avail = avail
+
+    def write(self, dfn, scratch):
+        self.done.set()
+        gb = 2**30
+        with open(os.path.join(dfn, "scratch-usage.txt"), "w") as F:
+            F.write("%-40s %.1fG\n" %("tmpfs size", shutil.disk_usage("/build").total / gb))
+            F.write("%-40s %.1fG\n" %("tmpfs peak use", self.peak / gb))
+            if self.min_avail is not None:
+                F.write("%-40s %.1fG\n" %("lowest available memory", self.min_avail / gb))
+            if scratch:
+                F.write("%-40s %.1fG\n" %("objects on disk", tree_size(scratch) / gb))
 
 def setup_from_pickle(args, pickle_params):
     """The script that invokes docker passes in some more detailed parameters
@@ -181,50 +1502,207 @@ def setup_from_pickle(args, pickle_params):
     args.src = p.get("src", None)
     args.project = p.get("project", None)
     args.rev = p.get("rev", 'HEAD')
+    args.revs = p.get("revs", None)
     args.checkpatch = p.get("checkpatch", True)
     args.checkpatch_root_dir = p.get("checkpatch_root_dir", None)
     args.sparse = p.get("sparse", True)
     args.gerrit = p.get("gerrit", True)
     args.show_all = p.get("show_all", False)
     args.warnings = p.get("warnings", True)
+    args.parallel_warnings = p.get("parallel_warnings", False)
     args.smatch = p.get("smatch", True)
     args.clang = p.get("clang", True)
+    args.fast_clang = p.get("fast_clang", False)
+    args.exhaustive = p.get("exhaustive", False)
+    args.checkout = p.get("checkout", "full")
+    args.fail_fast = p.get("fail_fast", False)
+    args.budget = p.get("budget", None)
+    args.logs = p.get("logs", "/logs")
+    args.watch = p.get("watch", False)
+    args.worker = p.get("worker", False)
+    args.image_id = p.get("image_id", None)
+    args.force = p.get("force", False)
+
+def kernel_series(args):
+    """State shared by the checks of all the commits of the series. They are
+    built with one config for the union of their targets, so the objects
+    carry over from one commit to the next."""
+    args.deps = DepsIndex(args)
+    args.smatch_db = SmatchDB(args)
+    args.config = None
+    args.targets = set()
+    for rev in args.revs:
+        args.targets.update(commit_targets(args, rev)[0])
 
 def kernel_ci(args):
-    if args.checkpatch:
-        checkpatch(args)
     build_dirlist(args)
+    widen_checkout(args, [os.path.join(os.path.dirname(I), "") for I in args.dirlist] +
+                   sorted(args.deps.headers(args.dirlist)))
+
+    def build_check(func, *fargs):
+        # The config is generated by the first check that builds, so a
+        # checkpatch failure with fail_fast does not wait for it
+        def run():
+            if args.config is None:
+                args.config = minimal_config(args)
+            func(args, *fargs)
+        return run
+
+    checks = collections.OrderedDict()
+    if args.checkpatch:
+        checks["checkpatch"] = lambda: checkpatch(args)
     if args.dirlist:
+        args.attribution = Attribution(args.rev)
+        tools = []
         if args.sparse:
-            smatch_and_sparse(args, "sparse")
-        if args.warnings:
-            warnings(args)
+            tools.append("sparse")
         if args.smatch:
-            smatch_and_sparse(args, "smatch")
+            tools.append("smatch")
+        if tools:
+            checks["static"] = build_check(static_checkers, tools)
+        if args.warnings:
+            checks["warnings"] = build_check(warnings)
         if args.clang:
-            clang(args)
+            checks["clang"] = build_check(clang)
+    # The fast clang check uses the compile commands of the gcc builds
+    after = {"clang": ("static", "warnings")} if args.fast_clang else None
+    run_checks(args, checks, after)
+    if args.dirlist:
+        args.deps.update(args)
+        args.smatch_db.update()
 
-def rdma_core_ci(args):
-    if args.checkpatch:
-        checkpatch(args)
+def userspace_build_cmd(args):
+    """Return the command for an incremental build of the fork. rdma-core is
+    built with ninja in a cmake build directory configured on first use and
+    kept for the whole CI run, iproute2 in its tree."""
+    if args.project == "iproute2":
+        return make_cmd(args), "stderr"
 
-def iproute2_ci(args):
+    odir = "/build/obj/rdma-core"
+    if not os.path.isdir(odir):
+        os.makedirs(odir)
+        # Man pages and pyverbs take longer to build than the libraries and
+        # providers the commits change
+        cmd = ["cmake", "-GNinja", "-DNO_MAN_PAGES=1", "-DNO_PYVERBS=1"]
+        if os.path.isdir("/ccache"):
+            cmd += ["-DCMAKE_C_COMPILER_LAUNCHER=ccache"]
+        subprocess.check_call(cmd + [args.src], cwd=odir, stdout=subprocess.DEVNULL)
+    return ["ninja", "-C", odir, "-j", str(args.num_jobs)], "stdout"
+
+def userspace_warnings(args):
+    """Build the parent commit and then the commit on top of it, report the
+    compiler findings the parent did not have. Only the files changed by the
+    commit are rebuilt, and findings are compared without the line so the
+    ones in code moved by the commit are not reported again."""
+    cmd, stream = userspace_build_cmd(args)
+    if args.show_all:
+        for diag in stream_cmd(args, cmd, "gcc", stream):
+            args.report.add("warnings", diag)
+        return
+
+    cache = BaselineCache(args, args.project, [])
+    base = cache.load("gcc")
+    if base is None:
+        subprocess.check_call(["git", "reset", "--hard", "-q", args.rev.decode() + "~1"])
+        base = set(I.key for I in stream_cmd(args, cmd, "gcc", stream) if I.severity)
+        # Restore
+        subprocess.check_call(["git", "reset", "--hard", "-q", args.rev])
+        cache.save("gcc", base)
+    base = set((I[0], I[3], I[4], I[5]) for I in base)
+
+    for diag in stream_cmd(args, cmd, "gcc", stream):
+        if diag.severity and (diag.file, diag.tool, diag.severity, diag.message) not in base:
+            args.report.add("warnings", diag)
+
+def userspace_ci(args):
+    checks = collections.OrderedDict()
     if args.checkpatch:
-        checkpatch(args)
+        checks["checkpatch"] = lambda: checkpatch(args)
+    if args.warnings:
+        checks["warnings"] = lambda: userspace_warnings(args)
+    run_checks(args, checks)
 
 parser = argparse.ArgumentParser(description='CI container')
 args = parser.parse_args()
 
-args.num_jobs = len(os.sched_getaffinity(0)) * 2
+# The CI queue shares the CPUs between the runs it does at the same time
+args.num_jobs = int(os.environ.get("CI_NUM_JOBS", 0)) or len(os.sched_getaffinity(0)) * 2
 pickle_data = os.environ.get("CI_PICKLE")
 setup_from_pickle(args, pickle_data)
-fork(args)
+args.report = Report()
+args.fragments = dict()
+usage = ScratchUsage()
+usage.start()
+if os.path.isdir('/ccache'):
+    os.environ['CCACHE_DIR'] = '/ccache'
+    os.environ['CCACHE_BASEDIR'] = '/build'
+    ccache_before = ccache_stats()
+
+# A patch series is checked commit by commit in the same fork, so the object
+# directories carry over and every step only rebuilds what it changed.
+revs = args.revs if args.revs else [args.rev]
+revs = [subprocess.check_output(["git", "rev-parse", I], cwd=args.src).strip() for I in revs]
+args.revs = revs
+results = ResultCache(args)
+keys = [results.key(I, args.src) for I in revs]
+args.rev = revs[-1]
+
+# Runs in the same worker or watch container share the fork and the objects
+lock = open("/build/.mkt-ci.lock", "w")
+try:
+    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+except BlockingIOError:
+    print("Waiting for the other CI run in this container to finish")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+
+# Nothing to fork when every commit was already checked
+if args.force or not all(results.has(I) for I in keys):
+    fork(args)
+    plan_scratch(args)
+    if args.project == "kernel":
+        kernel_series(args)
+else:
+    args.tree = args.src
+    args.scratch = None
+
+for rev, key in zip(revs, keys):
+    if len(revs) > 1:
+        print("\n==> Checking", end=' ', flush=True)
+        subprocess.check_call(["git", "--no-pager", "log", "--oneline", "-n1", rev],
+                              cwd=args.src)
+    args.rev = rev
+    args.report.start(args.rev)
+    if not args.force and results.replay(key, args.report):
+        continue
+    if len(revs) > 1:
+        subprocess.check_call(["git", "checkout", "-q", rev])
+
+    args.partial = False
+    if args.project == "kernel":
+        kernel_ci(args)
+
+    if args.project in ("rdma-core", "iproute2"):
+        userspace_ci(args)
+    # A partial run is not the verdict for the commit
+    if not args.partial:
+        results.save(key, args.report.current())
+    if args.fail_fast and args.report.findings(args.report.rev):
+        break
 
-if args.project == "kernel":
-    kernel_ci(args)
+if len(revs) > 1:
+    args.report.summary(args.src)
 
-if args.project == "rdma-core":
-    rdma_core_ci(args)
+if os.path.isdir(args.logs):
+    args.report.write(args.logs)
+    if os.path.isdir('/ccache'):
+        write_ccache_stats(args.logs, ccache_before)
+    usage.write(args.logs, args.scratch)
+# Entries of the caches that were not used for a while
+prune_cache(cache_dir("check"), 14)
+prune_cache(cache_dir("baseline"), 14)
+prune_cache(results.dfn, 90)
 
-if args.project == "iproute2":
-    iproute2_ci(args)
+# The watch mode and the workers build incrementally in the same objects
+if args.scratch and not args.watch and not args.worker:
+    shutil.rmtree(args.scratch, ignore_errors=True)
+    os.unlink(args.scratch + ".lock")
@@ -0,0 +1,20 @@
+"""kbuild helpers shared by the scripts that run inside the containers,
+do-build.py and do-ci.py import it from /plugins"""
+
+import os
+import re
+
+def object_target(f):
+    """Return the kbuild object target for a C file, or None if the Makefile
+    of its directory does not build it, like for #included .c files"""
+    if not f.endswith(".c") or not os.path.exists(f):
+        return None
+    obj = os.path.basename(f)[:-2] + ".o"
+    for mk in ("Kbuild", "Makefile"):
+        try:
+            with open(os.path.join(os.path.dirname(f), mk)) as F:
+                if re.search(r"(^|[\s=])%s\b" %(re.escape(obj)), F.read(), re.M):
+                    return f[:-2] + ".o"
+        except FileNotFoundError:
+            continue
+    return None
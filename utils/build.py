@@ -3,22 +3,85 @@
 import os
 import utils
 from utils.docker import *
+from utils.git import git_commit_id, git_output, in_directory
 import inspect
+import hashlib
+import shutil
+import subprocess
 import pickle
 import base64
 from utils.config import username, group
+from utils.cmdline import get_cache_fn
 
 section = utils.load_config_file()
 
+def scratch_size():
+    """Size of the /build tmpfs of the CI in GB. Half of the memory available
+    now, the other half is left for the compilers. Object directories that do
+    not fit are moved to disk by do-ci.py."""
+    with open("/proc/meminfo") as F:
+        for line in F:
+            if line.startswith("MemAvailable:"):
+                avail = int(line.split()[1]) // (1024 * 1024)
+                return max(2, avail // 2)
+    return 10
+
+def variant_dir(src, name):
+    """Return the object directory of the build variant name of the kernel
+    tree in src, in the build directory of the MKT config. Trees with the same
+    name in different places get different directories."""
+    area = section.get('build', None)
+    if area is None:
+        exit("Please configure build directory in MKT config.")
+    src = os.path.realpath(src)
+    tree = "%s-%s" % (os.path.basename(src),
+                      hashlib.sha256(src.encode()).hexdigest()[:12])
+    return os.path.join(area, tree, name)
+
+def rev_worktree(src, rev):
+    """Return a checkout of rev of the tree in src, kept in the build
+    directory of the MKT config. Like the fork of the CI it is an empty
+    repository with the objects of src as alternates. The checkout is done
+    once per revision, later builds of it reuse its objects."""
+    area = section.get('build', None)
+    if area is None:
+        exit("Please configure build directory in MKT config.")
+    with in_directory(src):
+        commit = git_commit_id(rev, fail_is_none=True)
+        if commit is None:
+            exit("Unknown revision %s" % (rev))
+        obj_dir = os.path.join(src, git_output(["rev-parse", "--git-path", "objects"]).decode())
+
+    dfn = os.path.join(area, "revs", "%s-%s" % (os.path.basename(os.path.normpath(src)),
+                                                 commit[:12]))
+    if os.path.isdir(dfn):
+        return dfn
+    tmp = "%s.%d" % (dfn, os.getpid())
+    os.makedirs(tmp)
+    subprocess.check_call(["git", "init", "-q"], cwd=tmp)
+    with open(os.path.join(tmp, ".git/objects/info/alternates"), "w") as F:
+        F.write(obj_dir + "\n")
+    subprocess.check_call(["git", "checkout", "-q", "--detach", commit], cwd=tmp)
+    try:
+        os.rename(tmp, dfn)
+    except OSError:
+        # Another build of the same revision was faster
+        shutil.rmtree(tmp)
+    return dfn
+
 class Build(object):
-    def  __init__(self, project):
-        if project == 'custom':
+    def  __init__(self, project, src=None):
+        if src is not None:
+            self.src = src
+        elif project == 'custom':
             self.src = section.get('src', None)
         else:
             self.src = section.get(project, None)
         if self.src is None:
             exit("Please configure source directory in MKT config.")
 
+        # src is switched to a revision worktree by mkt build --rev
+        self.tree = self.src
         self.project = project
         self.pickle = dict()
 
@@ -35,7 +98,7 @@ class Build(object):
     def _run_cmd(self, supos, build_recipe, image_name):
         ccache = section.get('ccache', None)
         docker_os = section.get('os', supos)
-        cmd = ["--rm", "-v", self.src + ":" + self.src + ":rw", "-it"]
+        cmd = ["--rm", "-v", self.tree + ":" + self.tree + ":rw", "-it"]
 
         src_dir = os.path.dirname(
                        os.path.abspath(inspect.getfile(inspect.currentframe()) + "/../"))
@@ -51,17 +114,69 @@ class Build(object):
     def run_build_cmd(self, supos, build_recipe=None):
         cmd = ["-e", "BUILD_PICKLE=%s" % (self._get_pickle())]
         cmd += ["-v", "%s:%s:ro" %(os.getenv("HOME"), os.getenv("HOME"))]
+        # Object directories of the kernel build variants
+        area = section.get('build', None)
+        if area:
+            os.makedirs(area, exist_ok=True)
+            cmd += ["-v", "%s:%s:rw" % (area, area)]
 
         return cmd + self._run_cmd(supos, build_recipe, "build")
 
-    def run_ci_cmd(self, supos):
-        cmd = ["--tmpfs", "/build:rw,exec,nosuid,mode=755,size=10G"]
+    def run_ci_cmd(self, supos, logs=None):
+        # Results cached by the CI are only valid for the same toolchain
+        self.pickle["image_id"] = docker_image_id(
+            make_image_name("ci", section.get('os', supos)))
+        cmd = ["--tmpfs", "/build:rw,exec,nosuid,mode=755,size=%dG" %(scratch_size())]
         cmd += ["-e", "CI_PICKLE=%s" % (self._get_pickle())]
+        cmd += ["--mount", "type=bind,source=%s,destination=/logs" % (logs or utils.config.runtime_logs_dir)]
+        # Results of previous runs, see ResultCache in do-ci.py
+        ci_cache = get_cache_fn("ci")
+        os.makedirs(ci_cache, exist_ok=True)
+        cmd += ["-v", "%s:/ci-cache" % (ci_cache)]
+        if self.pickle.get("checkout") == "overlay":
+            # do-ci.py mounts the overlay of the cached base tree itself
+            cmd += ["--cap-add", "SYS_ADMIN", "--security-opt", "apparmor=unconfined"]
         if self.pickle["src"] != self.pickle["checkpatch_root_dir"]:
             cmd += ["-v", "%s:%s:ro" %(self.pickle["checkpatch_root_dir"], self.pickle["checkpatch_root_dir"])]
 
         return cmd + self._run_cmd(supos, None, "ci")
 
+    def _worker(self, image_name, supos, cmd):
+        """Return the long lived container that runs the builds of the project
+        with image_name, started with the docker run arguments in cmd. A
+        worker of another version of the image is replaced."""
+        image_id = docker_image_id(
+            make_image_name(image_name, section.get('os', supos))) or ""
+        name = "mkt-%s-%s-%s" % (image_name, username(), self.project)
+        cur = docker_output(["ps", "--all", "--filter", "name=^%s$" % (name),
+                             "--format", '{{.Label "mkt.image"}} {{.Status}}']).decode()
+        if cur and not (cur.startswith(image_id + " Up") and image_id):
+            docker_call(["rm", "--force", name])
+            cur = None
+        if not cur:
+            cmd = [I for I in cmd if I != "-it"]
+            docker_call(["run", "--detach", "--name", name,
+                         "--label", "mkt.image=%s" % (image_id)] + cmd + ["sleep", "infinity"])
+        return name
+
+    def worker_build_cmd(self, supos):
+        """docker exec arguments to build in the worker"""
+        name = self._worker("build", supos, self.run_build_cmd(supos))
+        return ["exec", "-it", "-w", self.src, "-e", "BUILD_PICKLE=%s" % (self._get_pickle()),
+                name]
+
+    def worker_ci_cmd(self, supos):
+        """docker exec arguments to run the CI in the worker. The worker lives
+        longer than the logs directory of a single run, so the directory of
+        all the runs is mounted and the one of this run goes in the pickle."""
+        logs = os.path.normpath(utils.config.runtime_logs_dir)
+        self.pickle["logs"] = os.path.join("/logs-all", os.path.basename(logs))
+        # The objects are kept for the next run in the worker
+        self.pickle["worker"] = True
+        cmd = ["-v", "%s:/logs-all" % (os.path.dirname(logs))] + self.run_ci_cmd(supos)
+        name = self._worker("ci", supos, cmd)
+        return ["exec", "-it", "-e", "CI_PICKLE=%s" % (self._get_pickle()), name]
+
 project_marks = {
         "libibverbs": "rdma-core",
         "rdma": "iproute2",
@@ -48,6 +48,7 @@ def init_config_file():
             'iproute2': '/images/' + username() + '/src/iproute2/',
             'logs': '/images/' + username() + '/logs/',
             'ccache': '/images/' + username() + '/ccache/',
+            'build': '/images/' + username() + '/build/',
         }
     except configparser.DuplicateSectionError:
         pass
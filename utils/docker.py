@@ -33,6 +33,16 @@ def docker_exec(args):
         'docker',
     ] + args)
 
+def docker_popen(args, **kwargs):
+    """Start docker in the background, kwargs are passed to Popen"""
+    with open('%sdocker.cmdline' %(utils.config.runtime_logs_dir), 'w+') as f:
+        f.write(" ".join(args))
+
+    return subprocess.Popen([
+        'sudo',
+        'docker',
+    ] + args, **kwargs)
+
 def docker_output(args, mode=None):
     """Run docker and return the output"""
     with open('%sdocker.cmdline' %(utils.config.runtime_logs_dir), 'w+') as f:
@@ -52,6 +62,15 @@ def docker_output(args, mode=None):
         raise ValueError("Bad mode %r" % (mode))
 
 
+def docker_image_id(name):
+    """Return the ID of a local image or None if it is not present"""
+    try:
+        return docker_output(
+            ["image", "inspect", "--format", "{{.Id}}", name]).decode()
+    except subprocess.CalledProcessError:
+        return None
+
+
 def docker_get_containers(label):
     containers = docker_output(
         ["ps", "--format", '"{{.Names}}"', "--filter",
@@ -105,6 +105,16 @@ def git_commit_id(thing, fail_is_none=False):
         bytes_join(thing, "^{commit}"), fail_is_none=fail_is_none)
 
 
+def git_patch_id(commit):
+    """Return the stable patch-id of a commit, it stays the same when the
+    commit is rebased or its message is changed"""
+    diff = git_output(["show", "--format=", "--no-color", commit], mode="raw")
+    o = git_output(["patch-id", "--stable"], input=diff)
+    if not o:
+        return None
+    return o.split()[0].decode()
+
+
 def git_root():
     """Return the top of the source directory we are currently in"""
     res = git_output(